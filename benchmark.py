@@ -0,0 +1,210 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import scraper
+
+# --- Configuration ---
+RESULTS_FILE = 'benchmark_results.json' # Every run is appended, so regressions show up across versions
+BASE_TIMESTAMP = datetime.datetime(2024, 1, 31, 23, 59, tzinfo=datetime.timezone.utc) # Newest synthetic tweet
+
+# Same markup the scraper relies on: primaryColumn, article[data-testid='tweet'], a status permalink wrapping
+# <time datetime> and the @handle span, and div[data-testid='tweetText']. Pages are lazy-loaded on scroll.
+TIMELINE_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Synthetic timeline</title>
+<style>article { display: block; height: 140px; border-bottom: 1px solid #ccc; }</style></head>
+<body>
+<div data-testid="primaryColumn"><section id="timeline"></section></div>
+<script>
+var cursor = 0, loading = false, exhausted = false;
+function render(tweet) {
+    var article = document.createElement('article');
+    article.setAttribute('data-testid', 'tweet');
+    article.innerHTML =
+        '<div data-testid="User-Name"><a href="/' + tweet.handle + '"><div dir="ltr"><span>' + tweet.name + '</span></div></a>' +
+        '<a href="/' + tweet.handle + '/status/' + tweet.id + '"><div dir="ltr"><span>@' + tweet.handle + '</span></div>' +
+        '<time datetime="' + tweet.timestamp + '"></time></a></div>' +
+        '<div data-testid="tweetText"><span>' + tweet.text + '</span></div>';
+    document.getElementById('timeline').appendChild(article);
+}
+function loadMore() {
+    if (loading || exhausted) { return; }
+    loading = true;
+    fetch('/api/timeline?cursor=' + cursor).then(function (response) { return response.json(); }).then(function (page) {
+        page.tweets.forEach(render);
+        cursor = page.next_cursor;
+        exhausted = page.next_cursor === null;
+        loading = false;
+    });
+}
+window.addEventListener('scroll', function () {
+    if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 400) { loadMore(); }
+});
+loadMore();
+</script>
+</body></html>
+"""
+
+# --- Functions ---
+
+def synthetic_tweet(index, minutes_between_tweets):
+    """Deterministic tweet number `index` of the synthetic timeline (newest first)."""
+    timestamp = BASE_TIMESTAMP - datetime.timedelta(minutes=index * minutes_between_tweets)
+    return {
+        'id': str(1750000000000000000 + index),
+        'handle': f"user{index % 97}",
+        'name': f"User {index % 97}",
+        'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'text': f"Synthetic tweet number {index} with some filler text to make the DOM realistic.",
+    }
+
+def start_timeline_server(tweet_count, page_size=20, latency_ms=0, minutes_between_tweets=5):
+    """Serves the synthetic timeline on a free local port in a background thread. Returns (server, base_url)."""
+
+    class TimelineHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == '/api/timeline':
+                time.sleep(latency_ms / 1000) # Artificial network/server latency per page
+                cursor = int(urllib.parse.parse_qs(url.query).get('cursor', ['0'])[0])
+                end = min(cursor + page_size, tweet_count)
+                page = {
+                    'tweets': [synthetic_tweet(i, minutes_between_tweets) for i in range(cursor, end)],
+                    'next_cursor': end if end < tweet_count else None,
+                }
+                self.respond('application/json', json.dumps(page).encode('utf-8'))
+            elif url.path == '/search':
+                self.respond('text/html; charset=utf-8', TIMELINE_PAGE.encode('utf-8'))
+            else:
+                self.send_error(404)
+
+        def respond(self, content_type, body):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Keep benchmark output readable
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TimelineHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scenario(driver, search_url, tweet_count, extraction_mode, scroll_wait, filter_days):
+    """Scrapes the whole synthetic timeline once and returns its metrics."""
+    driver.resource_monitor.read_log() # Leave earlier scenarios' requests to the old monitor
+    driver.resource_monitor = scraper.SessionResourceMonitor(driver, driver.resource_monitor.profile, driver.resource_monitor.keep_messages)
+    scraper.count_driver_commands(driver)
+    commands_before = driver.command_count
+    tracemalloc.start()
+    started = time.perf_counter()
+    first_tweet_seconds = None
+    tweets = scraper.TweetColumns(scraper.OUTPUT_FIELDS) # Compact column buffers, as TweetWriter keeps them
+    # iter_tweets is what scrape_tweets wraps; consuming it directly gives the time to the first tweet
+    for tweet in scraper.iter_tweets(driver, search_url, max_tweets=tweet_count, extraction_mode=extraction_mode,
+                                     scroll_wait=scroll_wait, scroll_pause_base=1, scroll_pause_max=2):
+        if first_tweet_seconds is None:
+            first_tweet_seconds = time.perf_counter() - started
+        tweets.append(tweet)
+    scrape_seconds = time.perf_counter() - started
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    commands = driver.command_count - commands_before
+
+    filter_end = BASE_TIMESTAMP.date()
+    filter_start = filter_end - datetime.timedelta(days=filter_days - 1)
+    filter_started = time.perf_counter()
+    filtered = scraper.filter_by_date(tweets, filter_start, filter_end) # Vectorized over a datetime64 column
+    filter_seconds = time.perf_counter() - filter_started
+
+    return {
+        'extraction_mode': extraction_mode,
+        'scroll_wait': scroll_wait,
+        'tweets': len(tweets),
+        'scrape_seconds': round(scrape_seconds, 3),
+        'tweets_per_sec': round(len(tweets) / scrape_seconds, 2) if scrape_seconds else 0,
+        'time_to_first_tweet_seconds': round(first_tweet_seconds, 3) if first_tweet_seconds is not None else None,
+        'driver_commands': commands,
+        'driver_commands_per_tweet': round(commands / len(tweets), 2) if tweets else None,
+        'python_peak_mb': round(python_peak / 1e6, 2),
+        'peak_renderer_rss_mb': round(driver.resource_monitor.peak_renderer_rss / 1e6, 1) or None,
+        'filtered_tweets': len(filtered),
+        'filter_seconds': round(filter_seconds, 4),
+    }
+
+def save_results(path, run):
+    """Appends this run to the JSON results file."""
+    runs = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(runs, f, indent=2)
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline scraper benchmark against a local synthetic timeline")
+    parser.add_argument('--tweets', type=int, default=300, help="Tweets in the synthetic timeline (default: 300)")
+    parser.add_argument('--page-size', type=int, default=20, help="Tweets lazy-loaded per scroll (default: 20)")
+    parser.add_argument('--latency-ms', type=int, default=150, help="Artificial latency per timeline page (default: 150)")
+    parser.add_argument('--extraction', nargs='+', default=['batched', 'element'], choices=['batched', 'element'],
+                        help="Extraction modes to compare (default: batched element)")
+    parser.add_argument('--scroll-wait', nargs='+', default=['event'], choices=['event', 'sleep'],
+                        help="Scroll wait strategies to compare (default: event)")
+    parser.add_argument('--filter-days', type=int, default=1, help="Days kept by the filter_by_date step (default: 1)")
+    parser.add_argument('--profile', choices=['default', 'lean'], default='lean', help="Browser profile (default: lean)")
+    parser.add_argument('--output', default=RESULTS_FILE, help=f"Results file (default: {RESULTS_FILE})")
+    args = parser.parse_args()
+
+    server, base_url = start_timeline_server(args.tweets, args.page_size, args.latency_ms)
+    print(f"Synthetic timeline with {args.tweets} tweets served at {base_url} ({args.latency_ms} ms latency per page).")
+    driver = scraper.create_driver(profile=args.profile)
+    scenarios = []
+    try:
+        for extraction_mode in args.extraction:
+            for scroll_wait in args.scroll_wait:
+                print("-" * 20)
+                print(f"Scenario: extraction={extraction_mode}, scroll_wait={scroll_wait}")
+                search_url = f"{base_url}/search?q=benchmark&run={len(scenarios)}"
+                result = run_scenario(driver, search_url, args.tweets, extraction_mode, scroll_wait, args.filter_days)
+                scenarios.append(result)
+                print(json.dumps(result, indent=2))
+    finally:
+        driver.quit()
+        server.shutdown()
+
+    run = {
+        'recorded_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'parameters': {
+            'tweets': args.tweets,
+            'page_size': args.page_size,
+            'latency_ms': args.latency_ms,
+            'filter_days': args.filter_days,
+            'profile': args.profile,
+        },
+        'scenarios': scenarios,
+    }
+    save_results(args.output, run)
+    print("-" * 20)
+    for result in scenarios:
+        print(f"{result['extraction_mode']:<8} {result['scroll_wait']:<6} {result['tweets_per_sec']:>8.2f} tweets/sec "
+              f"{result['driver_commands_per_tweet']} cmds/tweet, first tweet after {result['time_to_first_tweet_seconds']}s")
+    print(f"Results appended to {args.output}")
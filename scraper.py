@@ -1,26 +1,185 @@
 import time
-import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.edge.service import Service as EdgeService
-from selenium.webdriver.edge.options import Options as EdgeOptions
-from webdriver_manager.microsoft import EdgeChromiumDriverManager
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+PROCESS_START = time.perf_counter() # Reference point for the startup timings (see mark_startup)
+import argparse
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import hashlib
+import html
+import http.client
+import importlib.util
+import json
+import mimetypes
 import os
+import queue
 import random
+import re
+import sqlite3
+import statistics
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken # Optional: needed to cache login sessions
+except ImportError:
+    Fernet = None
+try:
+    import psutil # Optional: renderer memory in session resource reports
+except ImportError:
+    psutil = None
+# pandas, selenium, webdriver-manager and pyarrow are imported inside the functions that use them, so --help,
+# config errors and the first prompt do not wait for them.
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None # Optional: Parquet/Arrow output
 
 # --- Configuration ---
 ACCOUNTS_FILE = 'accounts.csv'
 PROXY_FILE = 'proxylist.csv'
+PROXY_PROBE_URL = 'https://x.com/robots.txt' # Fetched through every proxy to measure latency/success (override with --proxy-probe-url)
+PROXY_PROBE_TIMEOUT = 8 # Seconds before a probe request counts as failed
+PROXY_PROBE_ROUNDS = 2 # Probe requests per proxy
+PROXY_PROBE_WORKERS = 16 # Proxies probed at the same time
+PROXY_HEALTH_FILE = 'proxy_health.json' # Cached probe results, reused by later runs
+PROXY_HEALTH_TTL = 30 * 60 # Seconds before a cached probe result is probed again
+SEEN_DB_FILE = 'seen_tweets.sqlite' # Persistent dedup index shared by repeat runs
+CHECKPOINT_FILE = 'scrape_checkpoint.json' # Scrape state used by --resume
+CHECKPOINT_EVERY = 50 # Tweets between output flushes / checkpoints
+WATERMARK_FILE = 'watermarks.json' # Newest tweet collected per watched query (--watch)
+WATCH_INTERVAL_MIN = 5 # Default minutes between polls in --watch mode
+OUTPUT_FIELDS = ['user', 'timestamp', 'text', 'status_id']
+OUTPUT_FORMATS = ['csv', 'jsonl', 'parquet', 'arrow']
+COLUMNAR_FORMATS = ('parquet', 'arrow') # Need pyarrow; written with COLUMNAR_COMPRESSION and a dictionary-encoded user column
+COLUMNAR_COMPRESSION = 'zstd'
+COLUMNAR_PART_ROWS = 1000 # Tweets per part file of a Parquet/Arrow output directory (and between their checkpoints)
+OLDER_TWEET_LIMIT = 20 # Consecutive tweets older than start_date before Latest scrolling stops
+SCROLL_WAIT_TIMEOUT = 10 # Max seconds to wait for new tweets to render after a scroll
+END_CONFIRM_PASSES = 3 # Scrolls in a row with no new tweets (and no throttling signs) before the results count as exhausted
+END_OF_RESULTS_MARKERS = ['no results for', 'no more results', 'try searching for something else'] # Lowercase page text
+THROTTLE_MARKERS = ['rate limit', 'too many requests', 'something went wrong', 'try reloading'] # Lowercase page text
+BACKOFF_BASE_SEC = 30 # First pause when throttled; doubles on every throttled retry in a row
+BACKOFF_MAX_SEC = 15 * 60 # Backoff cap (one rate-limit window), also for the site's own retry-after
+BACKOFF_MAX_RETRIES = 6 # Throttled retries in a row before the scrape gives up (see ThrottledError)
+MIN_SCROLL_DELAY = 1.0 # Politeness floor (seconds) between scrolls, even when tweets render sooner
+PAGE_HEAP_JS = "return window.performance && performance.memory ? performance.memory.usedJSHeapSize : null;"
+SHARD_WORKERS = 2 # Logged-in browser sessions used by --shard
+SHARD_MAX_ATTEMPTS = 3 # Tries per shard (each on a different worker when possible)
+TIMELINE_RESPONSE_PATTERN = re.compile(r'/graphql/[^/]+/(SearchTimeline|UserTweets|UserTweetsAndReplies)\b') # Captured by the 'network' extraction mode
+NETWORK_OUTPUT_FIELDS = OUTPUT_FIELDS + ['likes', 'retweets', 'replies', 'quotes', 'reply_to_status_id', 'quoted_status_id', 'media']
+MEDIA_FIELDS = ['media', 'links'] # Image/video and outbound link URLs, added to the output with --download-media
+NETWORK_RECORD_DIR = None # If set, captured timeline responses are saved here as JSON fixtures
+LEAN_WINDOW_SIZE = '1280,900' # Fixed viewport of the 'lean' browser profile
+LEAN_BLOCKED_URLS = [ # Requests the 'lean' profile never lets through (Network.setBlockedURLs patterns)
+    '*pbs.twimg.com/media/*', '*pbs.twimg.com/profile_images/*', '*pbs.twimg.com/card_img/*', '*video.twimg.com/*',
+    '*.jpg*', '*.jpeg*', '*.png*', '*.gif*', '*.webp*', '*.mp4*', '*.m3u8*', '*.m4s*', '*.woff*', '*.ttf*', '*.otf*',
+]
+RUN_REPORT_FILE = 'run_report.json' # Structured timings/counters written at the end of every run
+LOG_LEVEL = 'info' # 'debug' adds per-tweet lines to the console output
+SESSION_DIR = 'sessions' # Encrypted per-account cookies/localStorage from previous logins
+SESSION_KEY_FILE = '.session_key' # Fernet key for SESSION_DIR, unless SCRAPER_SESSION_KEY is set
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+MEDIA_WORKERS = 8 # Parallel media/link downloads (--media-workers)
+MEDIA_TIMEOUT = 30 # Seconds per download connection/read
+MEDIA_MAX_BYTES = 100 * 1024 * 1024 # Larger downloads are abandoned
+MEDIA_MAX_REDIRECTS = 5
+MEDIA_MANIFEST_FILE = 'manifest.jsonl' # In the --download-media directory: one line per (tweet, URL)
+EDGE_DRIVER_PATH = os.environ.get('EDGE_DRIVER_PATH') # Local msedgedriver used when it cannot be resolved online (--driver-path)
+DRIVER_CACHE_FILE = '.driver_path.json' # msedgedriver path resolved by an earlier run
+DRIVER_CACHE_TTL = 24 * 60 * 60 # Seconds before the cached driver path is resolved online again
+
+# --- Instrumentation ---
+
+class RunMetrics:
+    """Thread-safe timers (grouped by kind, e.g. 'phase' or 'webdriver_command') and counters for one run, exported as JSON or Prometheus text."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.timers = {}
+        self.counters = {}
+
+    def observe(self, kind, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(kind, {}).setdefault(name, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            timer['count'] += 1
+            timer['total_seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time.perf_counter() - started)
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        with self.lock:
+            return {
+                'started_at': datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'timers': {kind: {name: dict(timer) for name, timer in timers.items()} for kind, timers in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    def to_prometheus(self):
+        report = self.report()
+        lines = [
+            '# HELP scraper_run_duration_seconds Wall-clock time of the run.',
+            '# TYPE scraper_run_duration_seconds gauge',
+            f"scraper_run_duration_seconds {report['duration_seconds']}",
+        ]
+        for kind, timers in report['timers'].items():
+            for suffix, field, help_text in (('seconds_total', 'total_seconds', 'Time spent'), ('calls_total', 'count', 'Number of timed calls')):
+                metric = f"scraper_{kind}_{suffix}"
+                lines.append(f"# HELP {metric} {help_text} per {kind.replace('_', ' ')}.")
+                lines.append(f"# TYPE {metric} counter")
+                lines.extend(f'{metric}{{{kind}="{name}"}} {timer[field]}' for name, timer in sorted(timers.items()))
+        for name, value in sorted(report['counters'].items()):
+            lines.append(f"# TYPE scraper_{name}_total counter")
+            lines.append(f"scraper_{name}_total {value}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path, prometheus_path=None):
+        """Writes the JSON run report (and Prometheus text if prometheus_path is given) and prints a phase summary."""
+        report = self.report()
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+        phases = report['timers'].get('phase', {})
+        summary = ', '.join(f"{name} {timer['total_seconds']:.1f}s" for name, timer in sorted(phases.items(), key=lambda item: -item[1]['total_seconds']))
+        print(f"Run report written to {json_path}. Time by phase: {summary or 'n/a'}")
+        startup = report['timers'].get('startup', {})
+        if startup:
+            print("Startup: " + ', '.join(f"{name.replace('_', ' ')} after {timer['total_seconds']:.2f}s" for name, timer in startup.items()))
+
+METRICS = RunMetrics()
+_startup_lock = threading.Lock()
+_startup_marks = set()
+
+def mark_startup(milestone):
+    """Records the time from process start to milestone ('first_prompt', 'first_page') the first time it is reached."""
+    with _startup_lock:
+        if milestone in _startup_marks:
+            return
+        _startup_marks.add(milestone)
+    METRICS.observe('startup', milestone, time.perf_counter() - PROCESS_START)
 
 # --- Functions ---
 
 def login_to_twitter(driver, email, username, password):
     """Handles the login process for Twitter. Returns True on success, False on failure."""
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
     try:
         print(f"Attempting login with email: {email}")
         driver.get("https://twitter.com/login")
@@ -125,6 +284,496 @@ def login_to_twitter(driver, email, username, password):
         print(f"An unexpected error occurred during the login process for {email}: {e}")
         return False
 
+_driver_path_lock = threading.Lock()
+_driver_path = None
+_driver_path_resolved = False
+
+def find_driver_path():
+    """Finds msedgedriver: the fresh DRIVER_CACHE_FILE path, else webdriver-manager (then cached), else EDGE_DRIVER_PATH or the stale cache. None if none exists."""
+    cached = None
+    if os.path.exists(DRIVER_CACHE_FILE):
+        try:
+            with open(DRIVER_CACHE_FILE, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+    if cached and os.path.exists(cached['path']) and time.time() - cached['resolved_at'] < DRIVER_CACHE_TTL:
+        print(f"Using cached Edge driver: {cached['path']}")
+        return cached['path']
+
+    try:
+        from webdriver_manager.microsoft import EdgeChromiumDriverManager
+        path = EdgeChromiumDriverManager().install()
+    except Exception as e:
+        print(f"Warning: Could not resolve the Edge driver online: {e}")
+        for fallback in (EDGE_DRIVER_PATH, cached and cached['path']):
+            if fallback and os.path.exists(fallback):
+                print(f"Using offline Edge driver: {fallback}")
+                return fallback
+        print("Warning: No local Edge driver found (set EDGE_DRIVER_PATH or --driver-path). Letting Selenium look for one.")
+        return None
+
+    tmp_path = f"{DRIVER_CACHE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'path': path, 'resolved_at': time.time()}, f)
+    os.replace(tmp_path, DRIVER_CACHE_FILE)
+    return path
+
+def resolve_driver_path():
+    """msedgedriver path for create_driver, found once per process (see find_driver_path) and shared by every session."""
+    global _driver_path, _driver_path_resolved
+    with _driver_path_lock:
+        if not _driver_path_resolved:
+            with METRICS.timer('phase', 'driver_resolve'):
+                _driver_path = find_driver_path()
+            _driver_path_resolved = True
+        return _driver_path
+
+def create_driver(selected_proxy=None, capture_network=False, profile='default'):
+    """Starts an Edge WebDriver with the stealth options used for scraping ('lean' profile: headless, no images/media/fonts) and a SessionResourceMonitor."""
+    from selenium import webdriver
+    from selenium.webdriver.edge.options import Options as EdgeOptions
+    from selenium.webdriver.edge.service import Service as EdgeService
+    print("Initializing WebDriver (Edge)...")
+    driver_path = resolve_driver_path() # Timed as its own 'driver_resolve' phase
+    startup_started = time.perf_counter() # So driver_startup does not count the resolve a second time
+    options = EdgeOptions()
+    options.use_chromium = True
+    # Stealth Options (Keep existing and add more)
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.add_experimental_option("excludeSwitches", ["enable-automation", "enable-logging"])
+    options.add_experimental_option('useAutomationExtension', False)
+    options.add_argument("--incognito")
+    options.add_argument(f"user-agent={USER_AGENT}")
+    options.add_argument("--lang=en-US") # Set language
+    options.add_argument("--disable-infobars") # Disable "Chrome is being controlled..." bar
+    if profile == 'lean':
+        options.add_argument("--headless=new")
+        options.add_argument(f"--window-size={LEAN_WINDOW_SIZE}")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--autoplay-policy=user-gesture-required")
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    else:
+        options.add_argument("--start-maximized") # Start maximized
+    options.add_argument("--disable-extensions") # Disable extensions
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-gpu') # Sometimes helps with stability/detection
+
+    if selected_proxy:
+        options.add_argument(f'--proxy-server={selected_proxy}')
+        print(f"WebDriver configured to use proxy: {selected_proxy}")
+    options.set_capability('ms:loggingPrefs', {'performance': 'ALL'})
+    options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+
+    service = EdgeService(driver_path) if driver_path else EdgeService() # No path: Selenium Manager finds a driver
+    driver = webdriver.Edge(service=service, options=options)
+    count_driver_commands(driver)
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    if profile == 'lean':
+        # Content settings only cover images; interception also drops video segments and web fonts
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS})
+    driver.resource_monitor = SessionResourceMonitor(driver, profile, keep_messages=capture_network)
+    driver.proxy = selected_proxy
+    print(f"WebDriver (Edge) initialized with enhanced options ({profile} profile).")
+    METRICS.observe('phase', 'driver_startup', time.perf_counter() - startup_started)
+    return driver
+
+# Keeps the Resource Timing buffer from filling up on long timelines (TIMELINE_STATE_JS reads its latest entries)
+CLEAR_RESOURCE_TIMINGS_JS = "performance.clearResourceTimings();"
+NETWORK_MESSAGES = ('Network.responseReceived', 'Network.loadingFinished') # Kept for extract_network_tweets
+
+class SessionResourceMonitor:
+    """Tracks bytes transferred (CDP Network.loadingFinished in the performance log, which it alone reads) and peak renderer RSS for one driver session."""
+
+    def __init__(self, driver, profile, keep_messages=False):
+        self.driver = driver
+        self.profile = profile
+        self.keep_messages = keep_messages
+        self.messages = []
+        self.bytes_transferred = 0
+        self.peak_renderer_rss = 0
+
+    def read_log(self):
+        """Drains the performance log, adding the encoded (on-the-wire) size of every finished request."""
+        for entry in self.driver.get_log('performance'):
+            message = json.loads(entry['message'])['message']
+            if message['method'] == 'Network.loadingFinished':
+                self.bytes_transferred += message['params'].get('encodedDataLength') or 0
+            if self.keep_messages and message['method'] in NETWORK_MESSAGES:
+                self.messages.append(message)
+
+    def take_messages(self):
+        """Network messages logged since the last call (keep_messages only)."""
+        self.read_log()
+        messages, self.messages = self.messages, []
+        return messages
+
+    def renderer_rss(self):
+        """Total RSS of the browser's renderer processes, or None without psutil."""
+        if psutil is None:
+            return None
+        try:
+            driver_process = psutil.Process(self.driver.service.process.pid)
+            total = 0
+            for child in driver_process.children(recursive=True):
+                try:
+                    if '--type=renderer' in ' '.join(child.cmdline()):
+                        total += child.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+            return total
+        except (psutil.Error, AttributeError):
+            return None
+
+    def sample(self):
+        try:
+            self.read_log()
+            self.driver.execute_script(CLEAR_RESOURCE_TIMINGS_JS)
+        except Exception:
+            pass # Page mid-navigation; the next sample picks the log up
+        rss = self.renderer_rss()
+        if rss:
+            self.peak_renderer_rss = max(self.peak_renderer_rss, rss)
+
+    def report(self, prefix=''):
+        try:
+            self.read_log() # Requests since the last sample
+        except Exception:
+            pass
+        rss_text = f"{self.peak_renderer_rss / 1e6:.0f} MB" if self.peak_renderer_rss else "n/a (install psutil)"
+        print(f"{prefix}Session resources ({self.profile} profile): {self.bytes_transferred / 1e6:.1f} MB transferred, peak renderer RSS {rss_text}.")
+
+_session_cipher_lock = threading.Lock()
+_session_cipher = None
+_session_key_error = None # Why the session cache is off despite cryptography being installed
+
+def get_session_cipher():
+    """Returns the Fernet cipher for cached sessions, creating the key file on first use. None if cryptography is missing or the key is unusable."""
+    global _session_cipher, _session_key_error
+    if Fernet is None:
+        return None
+    with _session_cipher_lock:
+        if _session_cipher is None and _session_key_error is None:
+            try:
+                key = os.environ.get('SCRAPER_SESSION_KEY')
+                if not key:
+                    if os.path.exists(SESSION_KEY_FILE):
+                        with open(SESSION_KEY_FILE, 'rb') as f:
+                            key = f.read().strip()
+                    else:
+                        key = Fernet.generate_key()
+                        fd = os.open(SESSION_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, 'wb') as f:
+                            f.write(key)
+                _session_cipher = Fernet(key)
+            except (OSError, ValueError) as e: # e.g. a passphrase in SCRAPER_SESSION_KEY or a corrupt key file
+                source = 'SCRAPER_SESSION_KEY' if os.environ.get('SCRAPER_SESSION_KEY') else SESSION_KEY_FILE
+                _session_key_error = f"{source} is not a usable Fernet key ({e})"
+                print(f"Warning: Session cache disabled: {_session_key_error}. Logging in without it.")
+        return _session_cipher
+
+def session_path(email):
+    """Cache file for an account's session; the file name does not reveal the email."""
+    return os.path.join(SESSION_DIR, hashlib.sha256(email.lower().encode('utf-8')).hexdigest()[:16] + '.session')
+
+def save_session(driver, email):
+    """Stores the logged-in cookies and localStorage for email, encrypted at rest."""
+    cipher = get_session_cipher()
+    if cipher is None:
+        if Fernet is None:
+            print("Session cache disabled: install 'cryptography' to store login sessions encrypted.")
+        return
+    try:
+        session = {
+            'saved_at': time.time(),
+            'cookies': driver.get_cookies(),
+            'local_storage': driver.execute_script("return Object.assign({}, window.localStorage);"),
+        }
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        with open(session_path(email), 'wb') as f:
+            f.write(cipher.encrypt(json.dumps(session).encode('utf-8')))
+        print(f"Saved login session for {email}.")
+    except Exception as e:
+        print(f"Warning: Could not save login session for {email}: {e}")
+
+# Where the site sends a browser whose session it does not accept: the login flow or the logged-out landing page
+LOGIN_FLOW_PATTERN = re.compile(r'^/(login|i/flow/login)\b')
+LOGIN_FORM_SELECTOR = "input[name='password'], input[autocomplete='username'], [data-testid='loginButton']"
+
+def on_login_flow(driver):
+    """True if the current page is the login flow or shows a login form (i.e. the session was not accepted)."""
+    from selenium.webdriver.common.by import By
+    try:
+        if LOGIN_FLOW_PATTERN.match(urllib.parse.urlsplit(driver.current_url).path):
+            return True
+        return any(element.is_displayed() for element in driver.find_elements(By.CSS_SELECTOR, LOGIN_FORM_SELECTOR))
+    except Exception:
+        return False # Cannot tell (e.g. the browser is gone): not proof that the session was rejected
+
+def restore_session(driver, email):
+    """Loads a cached session for email into driver. Returns True if the timeline loads with it; a session the site rejects is discarded."""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+    path = session_path(email)
+    cipher = get_session_cipher()
+    if cipher is None or not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            session = json.loads(cipher.decrypt(f.read()))
+    except (InvalidToken, ValueError) as e:
+        print(f"Discarding unreadable cached session for {email}: {e or 'invalid key'}")
+        os.remove(path)
+        return False
+
+    now = time.time()
+    if any(cookie.get('expiry') and cookie['expiry'] < now for cookie in session['cookies'] if cookie['name'] in ('auth_token', 'ct0')):
+        print(f"Cached session for {email} has expired.")
+        os.remove(path)
+        return False
+
+    try:
+        print(f"Restoring cached session for {email}...")
+        driver.get("https://twitter.com/") # Cookies can only be set for the current domain
+        driver.delete_all_cookies()
+        for cookie in session['cookies']:
+            try:
+                driver.add_cookie(cookie)
+            except Exception:
+                pass # e.g. a cookie for another subdomain
+        driver.execute_script(
+            "for (const [key, value] of Object.entries(arguments[0])) { window.localStorage.setItem(key, value); }",
+            session['local_storage'],
+        )
+        driver.get("https://twitter.com/home")
+        WebDriverWait(driver, 15).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, "div[data-testid='primaryColumn']"))
+        )
+        print(f"Cached session for {email} is valid. Timeline verified, skipping login.")
+        return True
+    except TimeoutException:
+        rejected = on_login_flow(driver)
+        if rejected:
+            print(f"Cached session for {email} was rejected. Logging in again.")
+        else:
+            print(f"Timeline did not load with the cached session for {email} (slow page or network?). Keeping it; logging in again.")
+    except (KeyError, TypeError) as e: # A session file missing its keys
+        rejected = True
+        print(f"Discarding malformed cached session for {email} ({e}). Logging in again.")
+    except Exception as e: # WebDriverException from get/delete_all_cookies/execute_script
+        rejected = False
+        print(f"Could not restore cached session for {email} ({e}). Keeping it; logging in again.")
+    if rejected:
+        os.remove(path)
+    try:
+        driver.delete_all_cookies()
+    except Exception:
+        pass # The login that follows reports a broken browser itself
+    return False
+
+def load_proxy_list(path=PROXY_FILE):
+    """Reads the proxy list (ip;port;http columns) and returns its HTTP proxies as 'ip:port' strings."""
+    import pandas as pd
+    proxy_df = pd.read_csv(path, delimiter=';')
+    http_proxies = proxy_df[proxy_df['http'] == 1]
+    return [f"{row['ip']}:{row['port']}" for _, row in http_proxies.iterrows()]
+
+def probe_proxy(proxy, probe_url=PROXY_PROBE_URL, timeout=PROXY_PROBE_TIMEOUT):
+    """Fetches probe_url through proxy once. Returns the latency in seconds, or None if the request failed."""
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': f"http://{proxy}", 'https': f"http://{proxy}"}))
+    started = time.perf_counter()
+    try:
+        with opener.open(probe_url, timeout=timeout) as response: # HTTP errors (status >= 400) raise too
+            response.read(1024)
+    except Exception:
+        return None
+    return time.perf_counter() - started
+
+class ProxyPool:
+    """Health-ranked proxies shared by every WebDriver session of a run, probed concurrently and cached in cache_path for ttl seconds."""
+
+    def __init__(self, proxies, probe_url=PROXY_PROBE_URL, cache_path=PROXY_HEALTH_FILE, ttl=PROXY_HEALTH_TTL,
+                 rounds=PROXY_PROBE_ROUNDS, workers=PROXY_PROBE_WORKERS, timeout=PROXY_PROBE_TIMEOUT):
+        self.proxies = list(dict.fromkeys(proxies))
+        self.probe_url = probe_url
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cache_lock = threading.Lock() # Serializes save_cache's read-modify-write of cache_path and its .tmp file
+        self.health = {} # proxy -> {'successes', 'attempts', 'latency', 'checked_at'}
+        self.in_use = {} # proxy -> sessions currently running on it
+        self.failed = set()
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read proxy health cache {self.cache_path}: {e}")
+            return {}
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        with self.cache_lock:
+            cache = self.load_cache()
+            with self.lock:
+                cache[self.probe_url] = dict(self.health)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+
+    def probe_one(self, proxy):
+        latencies = [latency for latency in (probe_proxy(proxy, self.probe_url, self.timeout) for _ in range(self.rounds))
+                     if latency is not None]
+        return {
+            'successes': len(latencies),
+            'attempts': self.rounds,
+            'latency': statistics.median(latencies) if latencies else None,
+            'checked_at': time.time(),
+        }
+
+    def probe(self, force=False):
+        """Probes every proxy without a fresh cached result (all of them with force=True)."""
+        cached = {} if force else self.load_cache().get(self.probe_url, {})
+        now = time.time()
+        fresh = {proxy: cached[proxy] for proxy in self.proxies if proxy in cached and now - cached[proxy]['checked_at'] < self.ttl}
+        stale = [proxy for proxy in self.proxies if proxy not in fresh]
+        print(f"Probing {len(stale)} proxies against {self.probe_url} ({len(fresh)} cached results still fresh)...")
+        probed = {}
+        if stale:
+            with METRICS.timer('phase', 'proxy_probe'):
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(stale))) as executor:
+                    futures = {executor.submit(self.probe_one, proxy): proxy for proxy in stale}
+                    for future in concurrent.futures.as_completed(futures):
+                        probed[futures[future]] = future.result()
+        with self.lock:
+            self.health = dict(fresh, **probed)
+        self.save_cache()
+
+        ranked = self.ranked()
+        print(f"{len(ranked)}/{len(self.proxies)} proxies healthy.")
+        for proxy in ranked[:5]:
+            health = self.health[proxy]
+            print(f"  {proxy}: {health['successes']}/{health['attempts']} ok, {health['latency'] * 1000:.0f} ms")
+        return ranked
+
+    def ranked(self):
+        """Healthy proxies, best first (highest success rate, then lowest latency)."""
+        with self.lock:
+            healthy = [proxy for proxy, health in self.health.items() if health['successes'] and proxy not in self.failed]
+            return sorted(healthy, key=lambda proxy: (-self.health[proxy]['successes'] / self.health[proxy]['attempts'],
+                                                      self.health[proxy]['latency']))
+
+    def acquire(self):
+        """Returns the best healthy proxy with the fewest sessions on it, or None if no proxy is healthy."""
+        ranked = self.ranked()
+        with self.lock:
+            if not ranked:
+                return None
+            proxy = min(ranked, key=lambda proxy: (self.in_use.get(proxy, 0), ranked.index(proxy)))
+            self.in_use[proxy] = self.in_use.get(proxy, 0) + 1
+            return proxy
+
+    def release(self, proxy):
+        with self.lock:
+            if self.in_use.get(proxy):
+                self.in_use[proxy] -= 1
+
+    def recheck(self, proxy):
+        """Probes proxy once more after a session error. A failing proxy is not handed out again. Returns True if healthy."""
+        if probe_proxy(proxy, self.probe_url, self.timeout) is not None:
+            return True
+        print(f"Proxy {proxy} failed its health check. Taking it out of rotation.")
+        METRICS.incr('proxy_failures')
+        with self.lock:
+            self.failed.add(proxy)
+            self.health.pop(proxy, None) # Dropped from the cache too, so the next run probes it again
+        self.save_cache()
+        return False
+
+def open_logged_in_session(accounts, selected_proxy=None, proxy_pool=None, **driver_options):
+    """Starts a driver and logs in with each account in turn (from its cached session when valid). Returns (driver, account email), or (None, None) if all fail."""
+    for account in accounts:
+        print("-" * 20)
+        driver = None
+        proxy = proxy_pool.acquire() if proxy_pool else selected_proxy
+        try:
+            driver = create_driver(proxy, **driver_options)
+
+            with METRICS.timer('phase', 'session_restore'):
+                restored = restore_session(driver, account['email'])
+            if restored:
+                return driver, account['email']
+
+            with METRICS.timer('phase', 'login'):
+                # --- NUOVO RITARDO INIZIALE ---
+                initial_delay = random.uniform(5, 10) # Attendi tra 5 e 10 secondi
+                print(f"Waiting for {initial_delay:.1f} seconds before loading login page...")
+                time.sleep(initial_delay)
+                # --- FINE NUOVO RITARDO ---
+
+                logged_in = login_to_twitter(driver, account['email'], account.get('username'), account['password'])
+            if logged_in:
+                print(f"Login successful with {account['email']}. Proceeding to scrape...")
+                save_session(driver, account['email'])
+                return driver, account['email']
+            else:
+                print(f"Login failed for {account['email']}. Possible CAPTCHA or incorrect credentials.")
+                print("\n>>> ATTENZIONE: Login fallito. <<<")
+                print(">>> Se è apparso un CAPTCHA, prova a risolverlo manualmente nel browser ora. <<<")
+                print(">>> Lo script attenderà 60 secondi prima di chiudere questo browser e provare l'account successivo. <<<\n")
+                time.sleep(60)
+                print("Timeout scaduto o CAPTCHA non risolto. Provo l'account successivo...")
+                driver.quit()
+                if proxy_pool and proxy:
+                    proxy_pool.release(proxy)
+                    proxy_pool.recheck(proxy) # Health is cached for PROXY_HEALTH_TTL: a dead proxy would get every next account
+
+        except Exception as e:
+            print(f"An error occurred setting up WebDriver or during login for {account['email']}: {e}")
+            if driver:
+                driver.quit()
+            if proxy_pool and proxy:
+                proxy_pool.release(proxy)
+                proxy_pool.recheck(proxy) # A dead proxy is not handed to the next account
+            continue
+
+    return None, None
+
+def reopen_if_proxy_failed(driver, accounts, proxy_pool, prefix='', **driver_options):
+    """After a failed scrape, moves to a new session on another proxy if the driver's proxy failed its recheck. Returns the driver to go on with, or None."""
+    if not proxy_pool or not driver.proxy or (driver.proxy not in proxy_pool.failed and proxy_pool.recheck(driver.proxy)):
+        return driver
+    print(f"{prefix}Switching to another proxy...")
+    driver.resource_monitor.report(prefix=prefix)
+    driver.quit()
+    proxy_pool.release(driver.proxy)
+    driver, account_email = open_logged_in_session(accounts, proxy_pool=proxy_pool, **driver_options)
+    if not driver:
+        print(f"{prefix}Could not log in again on another proxy.")
+        return None
+    print(f"{prefix}Logged in as {account_email} via {driver.proxy or 'no proxy'}.")
+    return driver
+
+def format_search_bound(value):
+    """Formats a since:/until: operand. Dates use YYYY-MM-DD, datetimes the second-precise YYYY-MM-DD_HH:MM:SS_UTC form."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(datetime.timezone.utc)
+        return value.strftime('%Y-%m-%d_%H:%M:%S_UTC')
+    return value.strftime('%Y-%m-%d')
+
 def build_search_url(query, start_date, end_date, mode, search_type='latest'):
     """Builds the Twitter search URL."""
     base_url = "https://twitter.com/search?q="
@@ -135,14 +784,16 @@ def build_search_url(query, start_date, end_date, mode, search_type='latest'):
     elif mode == 'user':
         query_parts.append(f"from%3A{query}")
     else:
-        import urllib.parse
         query_parts.append(urllib.parse.quote(query))
 
     if start_date:
-        query_parts.append(f"since%3A{start_date.strftime('%Y-%m-%d')}")
+        query_parts.append(f"since%3A{format_search_bound(start_date)}")
     if end_date:
-        end_date_inclusive = end_date + datetime.timedelta(days=1)
-        query_parts.append(f"until%3A{end_date_inclusive.strftime('%Y-%m-%d')}")
+        if isinstance(end_date, datetime.datetime):
+            query_parts.append(f"until%3A{format_search_bound(end_date)}") # Exact (exclusive) bound
+        else:
+            end_date_inclusive = end_date + datetime.timedelta(days=1)
+            query_parts.append(f"until%3A{format_search_bound(end_date_inclusive)}")
 
     search_query = "%20".join(query_parts)
 
@@ -154,198 +805,1484 @@ def build_search_url(query, start_date, end_date, mode, search_type='latest'):
     print(f"Constructed Search URL: {full_url}")
     return full_url
 
-def scrape_tweets(driver, search_url, max_tweets=100, scroll_pause_base=3, scroll_pause_max=6, long_pause_min_sec=300, long_pause_max_sec=720):
-    """Navigates to the search URL and scrapes tweets with rate limit handling."""
-    driver.get(search_url)
-    try:
-        # Wait for the first batch of tweets to appear
-        WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "article[data-testid='tweet']"))
-        )
-        print("Search results page loaded.")
-    except TimeoutException:
-        print("Error: Timed out waiting for initial tweets to load. Check search URL or selectors.")
-        return [] # Return empty list if no tweets load initially
+def count_driver_commands(driver):
+    """Wraps driver.execute so every WebDriver command is counted on driver.command_count and timed in METRICS."""
+    if not hasattr(driver, 'command_count'):
+        original_execute = driver.execute
+        driver.command_count = 0
+
+        def counting_execute(driver_command, params=None):
+            driver.command_count += 1
+            started = time.perf_counter()
+            try:
+                return original_execute(driver_command, params)
+            finally:
+                METRICS.observe('webdriver_command', driver_command, time.perf_counter() - started)
+
+        driver.execute = counting_execute
+    return driver
+
+# Collects handle, timestamp, status permalink and text for every rendered tweet in one round trip; with arguments[0]
+# (collect media) also the media and outbound link URLs. Photos are requested in their original size (name=orig).
+EXTRACT_TWEETS_JS = """
+var collectMedia = arguments[0];
+var internalHosts = ['x.com', 'twitter.com', 'mobile.twitter.com', 'mobile.x.com'];
+function mediaUrls(article) {
+    var urls = [];
+    article.querySelectorAll("[data-testid='tweetPhoto'] img, video").forEach(function (el) {
+        var url = el.tagName === 'VIDEO' ? (/^https?:/.test(el.src) ? el.src : el.poster) : el.src; // Streamed videos have blob: sources
+        if (url && el.tagName === 'IMG') {
+            var photo = new URL(url);
+            if (photo.hostname === 'pbs.twimg.com' && photo.pathname.indexOf('/media/') === 0) {
+                photo.searchParams.set('name', 'orig'); // The timeline renders name=small/thumb
+                url = photo.href;
+            }
+        }
+        if (url && urls.indexOf(url) === -1) { urls.push(url); }
+    });
+    return urls;
+}
+function linkUrls(article) {
+    var urls = [];
+    article.querySelectorAll("div[data-testid='tweetText'] a[href], [data-testid='card.wrapper'] a[href]").forEach(function (a) {
+        if (/^https?:/.test(a.href) && internalHosts.indexOf(a.hostname) === -1 && urls.indexOf(a.href) === -1) { urls.push(a.href); }
+    });
+    return urls;
+}
+return Array.from(document.querySelectorAll("article[data-testid='tweet']")).map(function (article) {
+    var timeEl = article.querySelector('time');
+    var permalinkEl = timeEl ? timeEl.closest("a[href*='/status/']") : article.querySelector("a[href*='/status/']");
+    var textEl = article.querySelector("div[data-testid='tweetText']");
+    var handle = null;
+    var spans = article.querySelectorAll("a[href*='/status/'] div[dir='ltr'] > span");
+    for (var i = 0; i < spans.length; i++) {
+        var spanText = spans[i].innerText || '';
+        if (spanText.indexOf('@') === 0) { handle = spanText; break; }
+    }
+    return {
+        user: handle,
+        timestamp: timeEl ? timeEl.getAttribute('datetime') : null,
+        permalink: permalinkEl ? permalinkEl.href : null,
+        text: textEl ? textEl.innerText : null,
+        extra: collectMedia ? {media: mediaUrls(article), links: linkUrls(article)} : {}
+    };
+});
+"""
+
+def extract_visible_tweets(driver, collect_media=False):
+    """Returns every rendered tweet as a dict (user, timestamp, permalink, text; with collect_media extra media/links) using a single execute_script call."""
+    return driver.execute_script(EXTRACT_TWEETS_JS, collect_media) or []
+
+def extract_visible_tweets_per_element(driver, collect_media=False):
+    """Legacy extraction: same output as extract_visible_tweets (without media/links), but several driver calls per tweet."""
+    from selenium.common.exceptions import NoSuchElementException
+    from selenium.webdriver.common.by import By
+    visible_tweets = []
+    for tweet in driver.find_elements(By.CSS_SELECTOR, "article[data-testid='tweet']"):
+        try:
+            timestamp_element = tweet.find_element(By.CSS_SELECTOR, "time")
+            timestamp_str = timestamp_element.get_attribute('datetime')
+            permalink_elements = timestamp_element.find_elements(By.XPATH, "./ancestor::a[contains(@href, '/status/')]")
+            permalink = permalink_elements[0].get_attribute('href') if permalink_elements else None
+            user_handle_elements = tweet.find_elements(By.CSS_SELECTOR, "a[href*='/status/'] div[dir='ltr'] > span") # Find handle within link
+            user_handle = None
+            for handle_elem in user_handle_elements:
+                if handle_elem.text.startswith('@'):
+                    user_handle = handle_elem.text
+                    break
+            tweet_text_element = tweet.find_element(By.CSS_SELECTOR, "div[data-testid='tweetText']")
+            visible_tweets.append({
+                'user': user_handle,
+                'timestamp': timestamp_str,
+                'permalink': permalink,
+                'text': tweet_text_element.text
+            })
+        except NoSuchElementException:
+            pass
+        except Exception as e:
+            print(f"Error parsing a tweet element: {e}")
+    return visible_tweets
+
+def _iter_tweet_results(node):
+    """Yields every tweet result object found under a 'tweet_results' key in a GraphQL timeline payload."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'tweet_results':
+                result = (value or {}).get('result')
+                if result:
+                    yield result.get('tweet', result) # Unwrap TweetWithVisibilityResults
+            else:
+                yield from _iter_tweet_results(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _iter_tweet_results(item)
+
+def media_download_url(media_item):
+    """Best download URL of a GraphQL media entity: the highest-bitrate MP4 for videos/GIFs, the original size for photos."""
+    variants = [variant for variant in media_item.get('video_info', {}).get('variants', []) if variant.get('content_type') == 'video/mp4']
+    if variants:
+        return max(variants, key=lambda variant: variant.get('bitrate', 0))['url']
+    url = media_item.get('media_url_https')
+    return f"{url}?name=orig" if url and media_item.get('type') == 'photo' else url
+
+def parse_timeline_payload(payload):
+    """Parses a SearchTimeline/UserTweets GraphQL response into raw tweet dicts like the DOM extractors', with engagement, media and links in 'extra'."""
+    tweets = []
+    for result in _iter_tweet_results(payload):
+        legacy = result.get('legacy')
+        if not legacy or not result.get('rest_id'):
+            continue
+        user_result = result.get('core', {}).get('user_results', {}).get('result', {})
+        screen_name = user_result.get('legacy', {}).get('screen_name') or user_result.get('core', {}).get('screen_name')
+        created_at = datetime.datetime.strptime(legacy['created_at'], '%a %b %d %H:%M:%S %z %Y')
+        note_text = result.get('note_tweet', {}).get('note_tweet_results', {}).get('result', {}).get('text')
+        media = legacy.get('extended_entities', legacy.get('entities', {})).get('media', [])
+        links = [item.get('expanded_url') for item in legacy.get('entities', {}).get('urls', []) if item.get('expanded_url')]
+        tweets.append({
+            'user': f"@{screen_name}" if screen_name else None,
+            'timestamp': created_at.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'permalink': f"https://twitter.com/{screen_name or 'i'}/status/{result['rest_id']}",
+            'text': html.unescape(note_text or legacy.get('full_text', '')),
+            'extra': {
+                'likes': legacy.get('favorite_count'),
+                'retweets': legacy.get('retweet_count'),
+                'replies': legacy.get('reply_count'),
+                'quotes': legacy.get('quote_count'),
+                'reply_to_status_id': legacy.get('in_reply_to_status_id_str'),
+                'quoted_status_id': legacy.get('quoted_status_id_str'),
+                'media': [url for url in (media_download_url(item) for item in media) if url],
+                'links': links,
+            },
+        })
+    return tweets
+
+def extract_network_tweets(driver, collect_media=False):
+    """Returns tweets parsed from timeline responses captured since the last call (requires capture_network)."""
+    if not hasattr(driver, 'pending_timeline_requests'):
+        driver.pending_timeline_requests = set() # Timeline requests whose bodies have not finished loading
+    pending = driver.pending_timeline_requests
+    tweets = []
+    for message in driver.resource_monitor.take_messages():
+        params = message.get('params', {})
+        if message['method'] == 'Network.responseReceived':
+            if TIMELINE_RESPONSE_PATTERN.search(params['response']['url']):
+                # Read by timeline_state: a 429 or an exhausted rate limit means throttling, with the site's reset time
+                driver.last_timeline_response = {'status': params['response'].get('status'), 'headers': params['response'].get('headers', {})}
+                if params['response'].get('status') != 200:
+                    continue
+                pending.add(params['requestId'])
+        elif message['method'] == 'Network.loadingFinished' and params.get('requestId') in pending:
+            pending.discard(params['requestId'])
+            try:
+                body = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': params['requestId']})
+                payload = json.loads(body['body'])
+            except Exception as e:
+                print(f"Could not read captured timeline response: {e}")
+                continue
+            if NETWORK_RECORD_DIR:
+                os.makedirs(NETWORK_RECORD_DIR, exist_ok=True)
+                with open(os.path.join(NETWORK_RECORD_DIR, f"timeline_{params['requestId']}.json"), 'w', encoding='utf-8') as f:
+                    json.dump(payload, f)
+            tweets.extend(parse_timeline_payload(payload))
+    return tweets
+
+EXTRACTION_MODES = {
+    'batched': extract_visible_tweets,
+    'element': extract_visible_tweets_per_element,
+    'network': extract_network_tweets,
+}
+
+STATUS_ID_PATTERN = re.compile(r'/([^/?#]+)/status/(\d+)')
+
+def parse_status_permalink(permalink):
+    """Returns (handle, status_id) parsed from a '/<handle>/status/<id>' permalink, or (None, None)."""
+    match = STATUS_ID_PATTERN.search(permalink or '')
+    if not match:
+        return None, None
+    return f"@{match.group(1)}", match.group(2)
+
+def tweet_key(tweet):
+    """Dedup key for a tweet record: its status ID, or handle + timestamp when no permalink was rendered."""
+    return tweet.get('status_id') or f"{tweet['user']}_{tweet['timestamp']}"
+
+class TweetIndex:
+    """Constant-time dedup index of collected tweet keys, optionally persisted to SQLite under scope (committed every commit_every keys or by flush())."""
+
+    def __init__(self, db_path=None, scope='', commit_every=200):
+        self.scope = scope
+        self.commit_every = commit_every
+        self.keys = set()
+        self.pending = []
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen_tweets ("
+                "scope TEXT NOT NULL, tweet_key TEXT NOT NULL, PRIMARY KEY (scope, tweet_key)) WITHOUT ROWID"
+            )
+            rows = self.conn.execute("SELECT tweet_key FROM seen_tweets WHERE scope = ?", (scope,))
+            self.keys.update(row[0] for row in rows)
+            print(f"Loaded {len(self.keys)} previously collected tweet IDs for '{scope}' from {db_path}.")
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """Records key. Returns False if it was already present."""
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        if self.conn:
+            self.pending.append((self.scope, key))
+            if self.commit_every and len(self.pending) >= self.commit_every:
+                self.flush()
+        return True
+
+    def flush(self):
+        if self.conn and self.pending:
+            self.conn.executemany("INSERT OR IGNORE INTO seen_tweets (scope, tweet_key) VALUES (?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+# Installs a MutationObserver, scrolls to the bottom and resolves once new tweet <article>s have been added
+# (after a short settle period so a whole batch renders), or when the timeout expires.
+SCROLL_AND_WAIT_JS = """
+var timeoutMs = arguments[0], settleMs = arguments[1], done = arguments[arguments.length - 1];
+var finished = false, settleTimer = null;
+function finish(rendered) {
+    if (finished) { return; }
+    finished = true;
+    observer.disconnect();
+    clearTimeout(timeoutTimer);
+    clearTimeout(settleTimer);
+    done({rendered: rendered, height: document.body.scrollHeight});
+}
+var observer = new MutationObserver(function (mutations) {
+    for (var i = 0; i < mutations.length; i++) {
+        var added = mutations[i].addedNodes;
+        for (var j = 0; j < added.length; j++) {
+            var node = added[j];
+            if (node.nodeType === 1 && (node.matches("article[data-testid='tweet']") || node.querySelector("article[data-testid='tweet']"))) {
+                clearTimeout(settleTimer);
+                settleTimer = setTimeout(function () { finish(true); }, settleMs);
+                return;
+            }
+        }
+    }
+});
+var timeoutTimer = setTimeout(function () { finish(false); }, timeoutMs);
+observer.observe(document.body, {childList: true, subtree: true});
+window.scrollTo(0, document.body.scrollHeight);
+"""
+
+def scroll_and_wait(driver, timeout=SCROLL_WAIT_TIMEOUT, min_delay=MIN_SCROLL_DELAY, settle=0.3):
+    """Scrolls to the bottom and returns (rendered, new scroll height) once new tweets render or timeout expires, taking at least min_delay."""
+    started = time.time()
+    driver.set_script_timeout(timeout + 5)
+    result = driver.execute_async_script(SCROLL_AND_WAIT_JS, int(timeout * 1000), int(settle * 1000))
+    remaining_delay = min_delay - (time.time() - started)
+    if remaining_delay > 0:
+        time.sleep(remaining_delay)
+    return result['rendered'], result['height']
+
+# Looks for end-of-results / throttling signs in one round trip: the empty-state block, non-tweet cells at the
+# bottom of the timeline (error banners) and the HTTP status of the last timeline request (Resource Timing).
+TIMELINE_STATE_JS = """
+var endMarkers = arguments[0], throttleMarkers = arguments[1], timelinePattern = new RegExp(arguments[2]);
+var column = document.querySelector("[data-testid='primaryColumn']") || document.body;
+var texts = [];
+var emptyState = column.querySelector("[data-testid='emptyState']");
+if (emptyState) { texts.push(emptyState.innerText); }
+var cells = column.querySelectorAll("[data-testid='cellInnerDiv']");
+for (var i = Math.max(0, cells.length - 3); i < cells.length; i++) {
+    if (!cells[i].querySelector("article[data-testid='tweet']")) { texts.push(cells[i].innerText); }
+}
+var text = texts.join(' ').toLowerCase();
+function firstMarker(markers) {
+    for (var i = 0; i < markers.length; i++) { if (text.indexOf(markers[i]) !== -1) { return markers[i]; } }
+    return null;
+}
+var timelineRequests = performance.getEntriesByType('resource').filter(function (entry) { return timelinePattern.test(entry.name); });
+var last = timelineRequests[timelineRequests.length - 1];
+return {
+    end_marker: emptyState ? (firstMarker(endMarkers) || 'empty state') : firstMarker(endMarkers),
+    throttle_marker: firstMarker(throttleMarkers),
+    last_status: last && last.responseStatus ? last.responseStatus : null
+};
+"""
+
+# Clicks the timeline's "Retry" button after an error banner, if there is one.
+RETRY_TIMELINE_JS = """
+var buttons = document.querySelectorAll("[data-testid='primaryColumn'] [role='button']");
+for (var i = 0; i < buttons.length; i++) {
+    if ((buttons[i].innerText || '').trim().toLowerCase() === 'retry') { buttons[i].click(); return true; }
+}
+return false;
+"""
+
+class ThrottledError(Exception):
+    """The site kept throttling the scrape through BACKOFF_MAX_RETRIES backoffs."""
+
+class ProxyFailedError(Exception):
+    """The driver's proxy failed its health check in the middle of a scrape."""
+
+class SearchLoadError(Exception):
+    """The search page showed neither tweets nor an end-of-results notice."""
+
+def rate_limit_retry_after(headers, now=None):
+    """Seconds the site asks to wait, from Retry-After or an exhausted x-rate-limit-remaining/x-rate-limit-reset pair. None if it asks nothing."""
+    headers = {name.lower(): str(value) for name, value in (headers or {}).items()}
+    if headers.get('retry-after', '').isdigit():
+        return int(headers['retry-after'])
+    if headers.get('x-rate-limit-remaining') == '0' and headers.get('x-rate-limit-reset', '').isdigit():
+        return max(0, int(headers['x-rate-limit-reset']) - (now or time.time()))
+    return None
+
+def timeline_state(driver):
+    """Classifies a page whose last scroll brought nothing new. Returns ('throttled', 'end' or 'unknown', reason, retry_after_seconds)."""
+    page = driver.execute_script(TIMELINE_STATE_JS, END_OF_RESULTS_MARKERS, THROTTLE_MARKERS, TIMELINE_RESPONSE_PATTERN.pattern) or {}
+    response = getattr(driver, 'last_timeline_response', None) or {}
+    status = response.get('status') or page.get('last_status')
+    retry_after = rate_limit_retry_after(response.get('headers'))
+    if status == 429:
+        return 'throttled', "HTTP 429 from the timeline", retry_after
+    if page.get('throttle_marker'):
+        return 'throttled', f"'{page['throttle_marker']}' shown on the page", retry_after
+    if retry_after is not None:
+        return 'throttled', "rate limit exhausted", retry_after
+    if page.get('end_marker'):
+        return 'end', f"'{page['end_marker']}' shown on the page", None
+    return 'unknown', None, None
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SEC, cap=BACKOFF_MAX_SEC, retry_after=None):
+    """Pause before throttled retry number attempt (0-based): base * 2**attempt with jitter, at least retry_after, at most cap."""
+    delay = base * 2 ** attempt * random.uniform(0.8, 1.0)
+    return min(cap, max(delay, retry_after or 0))
+
+def with_until_bound(search_url, until):
+    """Returns search_url with its until: operand replaced by until (a date or datetime, see format_search_bound)."""
+    parts = urllib.parse.urlsplit(search_url)
+    params = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    rebuilt = []
+    for name, value in params:
+        if name == 'q':
+            terms = [term for term in value.split(' ') if term and not term.startswith('until:')]
+            value = ' '.join(terms + [f"until:{format_search_bound(until)}"])
+        rebuilt.append((name, value))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(rebuilt, quote_via=urllib.parse.quote)))
+
+def load_search_page(driver, search_url):
+    """Opens a search URL and waits for the first tweets. Returns False if none appear."""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+    with METRICS.timer('phase', 'page_load'):
+        driver.get(search_url)
+        try:
+            # Wait for the first batch of tweets to appear
+            WebDriverWait(driver, 15).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, "article[data-testid='tweet']"))
+            )
+            print("Search results page loaded.")
+            mark_startup('first_page')
+            return True
+        except TimeoutException:
+            print("Error: Timed out waiting for initial tweets to load. Check search URL or selectors.")
+            return False
+
+def page_heap_mb(driver):
+    """Used JS heap of the current page in MB (performance.memory), or None if the browser does not expose it."""
+    used = driver.execute_script(PAGE_HEAP_JS)
+    return used / 1e6 if used else None
+
+def iter_tweets(driver,
+                search_url,
+                max_tweets=100,
+                scroll_pause_base=3,
+                scroll_pause_max=6,
+                backoff_base_sec=BACKOFF_BASE_SEC,
+                backoff_max_sec=BACKOFF_MAX_SEC,
+                extraction_mode='batched',
+                seen_index=None,
+                start_date=None,
+                end_date=None,
+                older_tweet_limit=None,
+                scroll_wait='event',
+                min_scroll_delay=MIN_SCROLL_DELAY,
+                recycle_after_passes=None,
+                recycle_memory_mb=None,
+                watermark=None,
+                raise_on_load_failure=False,
+                stop_event=None,
+                collect_media=False,
+                outcome=None,
+                proxy_pool=None):
+    """Navigates to the search URL and yields each new tweet as it is scraped, with rate limit handling."""
+    if outcome is None:
+        outcome = {}
+    outcome['stop_reason'] = None
+    if seen_index is None:
+        seen_index = TweetIndex()
+    start_dt, end_dt = date_window(start_date, end_date)
+    out_of_window_keys = set() # Seen but dropped, so each one counts once towards older_tweet_limit
+    consecutive_older_tweets = 0
+    reached_watermark = False
+    extract_tweets = EXTRACTION_MODES[extraction_mode]
+    skipped_extra = () if collect_media else [field for field in MEDIA_FIELDS if field not in output_fields_for(extraction_mode)]
+    count_driver_commands(driver)
+    resource_monitor = getattr(driver, 'resource_monitor', None)
+    if extraction_mode == 'network':
+        driver.resource_monitor.take_messages() # Drop responses captured by earlier pages
+    scrape_start = time.time()
+    if not load_search_page(driver, search_url):
+        if raise_on_load_failure:
+            state, reason, _ = timeline_state(driver)
+            if state != 'end':
+                raise SearchLoadError(f"No tweets loaded ({reason or 'no end-of-results notice either'})")
+            outcome['stop_reason'] = 'end'
+        return # Yield nothing if no tweets load initially
+
+    long_run = bool(recycle_after_passes or recycle_memory_mb)
+    passes_since_recycle = 0
+    page_recycles = 0
+    peak_heap_mb = 0
+    oldest_tweet_dt = None
+    recycled_at_dt = None # oldest_tweet_dt at the last recycle; unchanged since then means nothing older is left
 
-    tweets_data = []
     last_height = driver.execute_script("return document.body.scrollHeight")
     tweets_gathered = 0
-    consecutive_scroll_failures = 0
-    max_consecutive_failures = 5 # Increased threshold slightly
+    consecutive_scroll_failures = 0 # Scrolls in a row that brought nothing new
+    consecutive_errors = 0
+    max_consecutive_errors = 5
+    throttle_retries = 0 # Throttled retries since the last new tweet
+    backoff_seconds = 0.0
 
     while tweets_gathered < max_tweets:
+        if stop_event and stop_event.is_set():
+            print("Stop requested. Ending the scrape.")
+            break
         new_tweets_found_in_pass = 0 # Reset for each pass
+        commands_at_pass_start = driver.command_count
         try:
             # --- Extract Tweets ---
-            tweet_elements = driver.find_elements(By.CSS_SELECTOR, "article[data-testid='tweet']")
-            processed_ids_in_pass = set() # Track IDs processed in this specific scroll pass
+            with METRICS.timer('phase', 'extraction'):
+                visible_tweets = extract_tweets(driver, collect_media)
+            METRICS.incr('scroll_passes')
 
-            for tweet in reversed(tweet_elements): # Process from bottom up, might help get newer ones first
+            # Process in timeline order so "consecutive older tweets" follows the timeline
+            for tweet in visible_tweets:
                 if tweets_gathered >= max_tweets:
                     break
-                try:
-                    # Use more robust way to get timestamp and user handle to create a unique ID
-                    timestamp_element = tweet.find_element(By.CSS_SELECTOR, "time")
-                    timestamp_str = timestamp_element.get_attribute('datetime')
-                    user_handle_elements = tweet.find_elements(By.CSS_SELECTOR, "a[href*='/status/'] div[dir='ltr'] > span") # Find handle within link
-                    user_handle = "unknown_user"
-                    for handle_elem in user_handle_elements:
-                        if handle_elem.text.startswith('@'):
-                            user_handle = handle_elem.text
-                            break
+                timestamp_str = tweet.get('timestamp')
+                if not timestamp_str or tweet.get('text') is None:
+                    continue # Same as a missing <time> or tweetText element
+                handle_from_link, status_id = parse_status_permalink(tweet.get('permalink'))
+                user_handle = tweet.get('user') or handle_from_link or "unknown_user"
 
-                    tweet_id = f"{user_handle}_{timestamp_str}" # Create a more reliable unique ID
+                tweet_info = {
+                    'user': user_handle,
+                    'timestamp': timestamp_str,
+                    'text': ' '.join(tweet['text'].split()), # Clean whitespace
+                    'status_id': status_id
+                }
+                tweet_info.update((field, value) for field, value in (tweet.get('extra') or {}).items() if field not in skipped_extra)
+                key = tweet_key(tweet_info)
 
-                    # Avoid reprocessing the same element multiple times within one scroll pass
-                    if tweet_id in processed_ids_in_pass:
+                if watermark and at_or_below_watermark(tweet_info, watermark):
+                    reached_watermark = True
+                    break
+
+                # Check if tweet already collected (in this scrape or, for a persistent index, an earlier run)
+                if key in seen_index or key in out_of_window_keys:
+                    continue
+
+                if start_dt or end_dt:
+                    try:
+                        tweet_dt = parse_tweet_timestamp(timestamp_str)
+                    except ValueError:
+                        print(f"Could not parse timestamp '{timestamp_str}'. Skipping tweet.")
+                        out_of_window_keys.add(key)
+                        continue
+                    if (start_dt and tweet_dt < start_dt) or (end_dt and tweet_dt > end_dt):
+                        out_of_window_keys.add(key)
+                        if start_dt and tweet_dt < start_dt:
+                            consecutive_older_tweets += 1
                         continue
-                    processed_ids_in_pass.add(tweet_id)
-
-                    # Check if tweet already collected (using the reliable ID)
-                    if tweet_id not in {t['id'] for t in tweets_data}:
-                        tweet_text_element = tweet.find_element(By.CSS_SELECTOR, "div[data-testid='tweetText']")
-                        tweet_text_raw = tweet_text_element.text
-                        tweet_text = ' '.join(tweet_text_raw.split()) # Clean whitespace
-
-                        tweet_info = {
-                            'id': tweet_id, # Keep ID for duplicate check
-                            'user': user_handle,
-                            'timestamp': timestamp_str,
-                            'text': tweet_text
-                        }
-                        tweets_data.append(tweet_info)
-                        tweets_gathered += 1
-                        new_tweets_found_in_pass += 1
 
-                except NoSuchElementException:
-                    pass
-                except Exception as e:
-                    print(f"Error parsing a tweet element: {e}")
+                consecutive_older_tweets = 0
+                if long_run:
+                    tweet_dt = parse_tweet_timestamp(timestamp_str)
+                    if oldest_tweet_dt is None or tweet_dt < oldest_tweet_dt:
+                        oldest_tweet_dt = tweet_dt
+                seen_index.add(key)
+                tweets_gathered += 1
+                new_tweets_found_in_pass += 1
+                METRICS.incr('tweets_collected')
+                if LOG_LEVEL == 'debug':
+                    print(f"  + {user_handle} {timestamp_str} {status_id or ''}: {tweet_info['text'][:80]}")
+                yield tweet_info
 
-            print(f"Pass complete. Gathered {new_tweets_found_in_pass} new tweets. Total: {tweets_gathered}/{max_tweets}")
+            if reached_watermark:
+                print(f"Reached the watermark ({watermark.get('status_id') or watermark['timestamp']}). No newer tweets left; stopping.")
+                outcome['stop_reason'] = 'watermark'
+                break
+
+            if older_tweet_limit and consecutive_older_tweets >= older_tweet_limit:
+                print(f"{consecutive_older_tweets} consecutive tweets older than {start_date}. Timeline has left the date window; stopping.")
+                break
+
+            if resource_monitor:
+                resource_monitor.sample()
+            pass_commands = driver.command_count - commands_at_pass_start
+            print(f"Pass complete. Gathered {new_tweets_found_in_pass} new tweets. Total: {tweets_gathered}/{max_tweets} (driver commands: {pass_commands})")
 
             if tweets_gathered >= max_tweets:
                 print("Reached max_tweets limit.")
                 break
 
-            # Reset failure counter if new tweets were found in this pass
+            # Reset failure counters if new tweets were found in this pass
+            consecutive_errors = 0
             if new_tweets_found_in_pass > 0:
                 consecutive_scroll_failures = 0
+                throttle_retries = 0
+
+            # --- Long-run mode: recycle the page before the DOM and heap grow too large ---
+            if long_run:
+                passes_since_recycle += 1
+                heap_mb = page_heap_mb(driver)
+                if heap_mb is not None:
+                    peak_heap_mb = max(peak_heap_mb, heap_mb)
+                    print(f"Page JS heap: {heap_mb:.0f} MB after {passes_since_recycle} passes on this page.")
+                memory_exceeded = recycle_memory_mb and heap_mb is not None and heap_mb >= recycle_memory_mb
+                passes_exceeded = recycle_after_passes and passes_since_recycle >= recycle_after_passes
+                if (memory_exceeded or passes_exceeded) and oldest_tweet_dt:
+                    if oldest_tweet_dt == recycled_at_dt:
+                        print(f"--- END OF RESULTS (no tweets older than {format_search_bound(oldest_tweet_dt)} since the last page recycle) ---")
+                        outcome['stop_reason'] = 'end'
+                        break
+                    recycled_at_dt = oldest_tweet_dt
+                    # +1s keeps tweets sharing the oldest second; the dedup index skips the ones already yielded
+                    recycle_url = with_until_bound(search_url, oldest_tweet_dt + datetime.timedelta(seconds=1))
+                    page_recycles += 1
+                    METRICS.incr('page_recycles')
+                    print(f"Recycling page (#{page_recycles}): reloading search until {format_search_bound(oldest_tweet_dt)}.")
+                    if not load_search_page(driver, recycle_url):
+                        print("No tweets older than the recycle point. Stopping.")
+                        break
+                    last_height = driver.execute_script("return document.body.scrollHeight")
+                    passes_since_recycle = 0
+                    continue
 
         except Exception as e:
             print(f"Error finding or processing tweet elements on page: {e}")
-            consecutive_scroll_failures += 1 # Count this as a failure
+            consecutive_errors += 1
+            if consecutive_errors >= max_consecutive_errors:
+                print(f"{consecutive_errors} errors in a row reading the page. Stopping.")
+                break
             time.sleep(random.uniform(scroll_pause_base, scroll_pause_max)) # Wait even if error
 
         # --- Scroll ---
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        scroll_pause = random.uniform(scroll_pause_base, scroll_pause_max) # Random pause between scrolls
-        time.sleep(scroll_pause)
-
-        new_height = driver.execute_script("return document.body.scrollHeight")
+        with METRICS.timer('phase', 'scroll_wait'):
+            if scroll_wait == 'event':
+                _, new_height = scroll_and_wait(driver, min_delay=min_scroll_delay)
+            else:
+                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+                scroll_pause = random.uniform(scroll_pause_base, scroll_pause_max) # Random pause between scrolls
+                time.sleep(scroll_pause)
+                new_height = driver.execute_script("return document.body.scrollHeight")
 
-        # --- Check if Scroll Worked / Handle Rate Limit ---
+        # --- Check if Scroll Worked: End of Results or Rate Limit ---
         if new_height == last_height:
             if new_tweets_found_in_pass == 0:
                 consecutive_scroll_failures += 1
-                print(f"Scroll height unchanged AND no new tweets found. Failure count: {consecutive_scroll_failures}/{max_consecutive_failures}")
-
-                if consecutive_scroll_failures >= max_consecutive_failures:
-                    print("--- RATE LIMIT SUSPECTED or END OF RESULTS ---")
-                    long_pause_duration = random.uniform(long_pause_min_sec, long_pause_max_sec)
-                    print(f"Pausing for {long_pause_duration / 60:.1f} minutes before retrying...")
-                    time.sleep(long_pause_duration)
+                state, reason, retry_after = timeline_state(driver)
+                if state == 'end':
+                    print(f"--- END OF RESULTS ({reason}) ---")
+                    outcome['stop_reason'] = 'end'
+                    break
+                if state == 'throttled':
+                    # A proxy dying mid-scroll shows the same "Something went wrong" banner: do not wait it out
+                    if throttle_retries == 0 and proxy_pool and getattr(driver, 'proxy', None) and not proxy_pool.recheck(driver.proxy):
+                        raise ProxyFailedError(f"Proxy {driver.proxy} failed its health check ({reason})")
+                    if throttle_retries >= BACKOFF_MAX_RETRIES:
+                        raise ThrottledError(f"Still throttled ({reason}) after {throttle_retries} backoffs ({backoff_seconds / 60:.1f} min).")
+                    pause = backoff_delay(throttle_retries, backoff_base_sec, backoff_max_sec, retry_after)
+                    throttle_retries += 1
+                    hint = f", site asks for {retry_after:.0f}s" if retry_after is not None else ""
+                    print(f"--- RATE LIMITED ({reason}{hint}) --- Backing off {pause / 60:.1f} minutes (retry {throttle_retries}/{BACKOFF_MAX_RETRIES})...")
+                    with METRICS.timer('phase', 'rate_limit_backoff'):
+                        if stop_event:
+                            stop_event.wait(pause)
+                        else:
+                            time.sleep(pause)
+                    METRICS.incr('rate_limit_backoffs')
+                    backoff_seconds += pause
+                    driver.last_timeline_response = None # Judge the next attempt on its own responses
+                    if driver.execute_script(RETRY_TIMELINE_JS):
+                        print("Clicked the timeline's Retry button.")
                     print("Resuming scroll attempts...")
-                    consecutive_scroll_failures = 0 # Reset counter after long pause
+                    consecutive_scroll_failures = 0
+                elif consecutive_scroll_failures >= END_CONFIRM_PASSES:
+                    print(f"--- END OF RESULTS ({consecutive_scroll_failures} scrolls without new tweets or throttling signs) ---")
+                    outcome['stop_reason'] = 'end'
+                    break
                 else:
-                    time.sleep(random.uniform(scroll_pause_base * 1.5, scroll_pause_max * 1.5))
+                    print(f"Scroll height unchanged AND no new tweets found. Confirming end of results: {consecutive_scroll_failures}/{END_CONFIRM_PASSES}")
+                    # Scroll back up a screen so the next scroll to the bottom triggers loading again
+                    driver.execute_script("window.scrollBy(0, -window.innerHeight);")
+                    with METRICS.timer('phase', 'scroll_wait'):
+                        time.sleep(random.uniform(scroll_pause_base * 1.5, scroll_pause_max * 1.5))
             else:
                  print("Scroll height unchanged, but new tweets were found in last pass. Continuing...")
         else:
             last_height = new_height
 
-    for tweet in tweets_data:
-        if 'id' in tweet:
-            del tweet['id']
+    seen_index.flush()
+    elapsed = time.time() - scrape_start
+    print(f"Scraping finished. Yielded {tweets_gathered} tweets.")
+    if long_run:
+        peak_text = f"{peak_heap_mb:.0f} MB" if peak_heap_mb else "n/a"
+        print(f"Long-run mode: {page_recycles} page recycles, peak page JS heap {peak_text}.")
+    if backoff_seconds:
+        print(f"Rate limit backoff: {backoff_seconds / 60:.1f} minutes in total.")
+    print(f"Extraction mode '{extraction_mode}': {tweets_gathered} tweets in {elapsed:.1f}s ({tweets_gathered / elapsed if elapsed else 0:.2f} tweets/sec).")
 
-    print(f"Scraping finished. Returning {len(tweets_data)} tweets.")
+def scrape_tweets(driver, search_url, max_tweets=100, **kwargs):
+    """Navigates to the search URL and returns the scraped tweets as a list. See iter_tweets for options."""
+    tweets_data = list(iter_tweets(driver, search_url, max_tweets=max_tweets, **kwargs))
     return tweets_data[:max_tweets] # Ensure we don't return more than requested
 
+def parse_tweet_timestamp(timestamp_str):
+    """Parses a tweet's ISO 8601 'datetime' attribute (e.g. 2024-01-31T12:00:00.000Z) into an aware datetime."""
+    return datetime.datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+
+def date_window(start_date, end_date):
+    """Returns the inclusive (start, end) UTC datetimes covering whole days start_date..end_date; a datetime end bound is exclusive, like until:."""
+    if isinstance(start_date, datetime.datetime):
+        start_dt = start_date
+    else:
+        start_dt = datetime.datetime.combine(start_date, datetime.datetime.min.time()).replace(tzinfo=datetime.timezone.utc) if start_date else None
+    if isinstance(end_date, datetime.datetime):
+        end_dt = end_date - datetime.timedelta(microseconds=1)
+    else:
+        end_dt = datetime.datetime.combine(end_date, datetime.datetime.max.time()).replace(tzinfo=datetime.timezone.utc) if end_date else None
+    return start_dt, end_dt
+
+class TweetColumns:
+    """Compact tweet records: one list per field instead of one dict per tweet."""
+    __slots__ = ('fields', 'columns')
+
+    def __init__(self, fields=OUTPUT_FIELDS):
+        self.fields = list(fields)
+        self.columns = {field: [] for field in self.fields}
+
+    @classmethod
+    def from_records(cls, records, fields=None):
+        records = list(records)
+        columns = cls(fields or list(dict.fromkeys(key for record in records for key in record)))
+        for record in records:
+            columns.append(record)
+        return columns
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def append(self, record):
+        for field in self.fields:
+            self.columns[field].append(record.get(field))
+
+    def records(self):
+        for values in zip(*(self.columns[field] for field in self.fields)):
+            yield dict(zip(self.fields, values))
+
+    def take(self, indices):
+        """New TweetColumns with only the rows at indices."""
+        taken = TweetColumns(self.fields)
+        for field in self.fields:
+            column = self.columns[field]
+            taken.columns[field] = [column[i] for i in indices]
+        return taken
+
+    def clear(self):
+        for column in self.columns.values():
+            column.clear()
+
+def columnar_table(columns):
+    """Builds a pyarrow Table from TweetColumns: dictionary-encoded user, UTC timestamp, integer counts, list media."""
+    import pyarrow as pa
+    arrays = {}
+    for field in columns.fields:
+        values = columns[field]
+        if field == 'user':
+            arrays[field] = pa.array(values, pa.string()).dictionary_encode()
+        elif field == 'timestamp':
+            arrays[field] = pa.array(parse_tweet_timestamps(values)).cast(pa.timestamp('ms', tz='UTC'), safe=False)
+        elif field in ('likes', 'retweets', 'replies', 'quotes'):
+            arrays[field] = pa.array(values, pa.int64())
+        elif field in MEDIA_FIELDS:
+            arrays[field] = pa.array(values, pa.list_(pa.string()))
+        else:
+            arrays[field] = pa.array(values, pa.string())
+    return pa.table(arrays)
+
+class TweetWriter:
+    """Appends tweet records to a CSV/JSONL file or a Parquet/Arrow directory of part files, flushing every batch_size records."""
+
+    def __init__(self, path, output_format='csv', batch_size=None, fields=OUTPUT_FIELDS):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        if output_format in COLUMNAR_FORMATS and not PYARROW_AVAILABLE:
+            raise ValueError(f"{output_format} output needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.output_format = output_format
+        self.batch_size = batch_size or (COLUMNAR_PART_ROWS if output_format in COLUMNAR_FORMATS else CHECKPOINT_EVERY)
+        self.fields = fields
+        self.buffer = TweetColumns(fields)
+        self.count = 0
+        self.file = None
+        self.csv_writer = None
+        self.next_part = None
+
+    def write(self, record):
+        """Buffers record. Returns True if that filled the buffer and it was flushed (everything written is on disk)."""
+        self.buffer.append(record)
+        self.count += 1
+        if len(self.buffer) >= self.batch_size:
+            return self.flush()
+        return False
+
+    def flush(self):
+        """Writes out the buffered records. Returns True if there were any."""
+        if not len(self.buffer):
+            return False
+        if self.output_format in COLUMNAR_FORMATS:
+            self.write_part()
+            return True
+        if self.file is None:
+            is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            if self.output_format == 'csv':
+                # utf-8-sig only emits the BOM at the start of the file, not when appending
+                self.file = open(self.path, 'a', newline='', encoding='utf-8-sig')
+                self.csv_writer = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction='ignore')
+                if is_new:
+                    self.csv_writer.writeheader()
+            else:
+                self.file = open(self.path, 'a', encoding='utf-8')
+        if self.output_format == 'csv':
+            # List fields (e.g. media URLs) become space-separated cells
+            self.csv_writer.writerows({key: ' '.join(value) if isinstance(value, list) else value for key, value in record.items()} for record in self.buffer.records())
+        else:
+            self.file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in self.buffer.records())
+        self.file.flush()
+        self.buffer.clear()
+        return True
+
+    def write_part(self):
+        """Writes the buffered columns as the next part file of the output directory (atomically, via a hidden temp file)."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.next_part is None:
+            os.makedirs(self.path, exist_ok=True)
+            parts = [name for name in os.listdir(self.path) if re.fullmatch(r'part-\d+\.\w+', name)]
+            self.next_part = max((int(name[5:].split('.')[0]) + 1 for name in parts), default=0)
+        part_name = f"part-{self.next_part:05d}.{self.output_format}"
+        tmp_path = os.path.join(self.path, f".{part_name}.tmp") # Dataset readers skip dot files
+        table = columnar_table(self.buffer)
+        if self.output_format == 'parquet':
+            pq.write_table(table, tmp_path, compression=COLUMNAR_COMPRESSION, use_dictionary=['user'])
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=COLUMNAR_COMPRESSION)
+            with pa.ipc.new_file(tmp_path, table.schema, options=options) as arrow_writer:
+                arrow_writer.write_table(table)
+        os.replace(tmp_path, os.path.join(self.path, part_name))
+        self.next_part += 1
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def save_checkpoint(path, state):
+    """Atomically writes the scrape state (job, output file/format/fields, --shard, count, oldest timestamp, dedup keys) as JSON."""
+    serializable = dict(state)
+    serializable['job'] = {key: value.isoformat() if isinstance(value, datetime.date) else value for key, value in state['job'].items()}
+    serializable['updated_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(serializable, f)
+    os.replace(tmp_path, path)
+
+def record_in_checkpoint(state, tweet):
+    """Counts a written tweet in the checkpoint state, tracking the oldest timestamp and the keys of tweets in that second."""
+    state['count'] += 1
+    key = tweet_key(tweet)
+    timestamp = parse_tweet_timestamp(tweet['timestamp'])
+    oldest = parse_tweet_timestamp(state['oldest_timestamp']) if state['oldest_timestamp'] else None
+    if oldest is None or timestamp.replace(microsecond=0) < oldest.replace(microsecond=0):
+        state['seen_keys'] = [key]
+    elif timestamp.replace(microsecond=0) == oldest.replace(microsecond=0):
+        state['seen_keys'].append(key)
+    if oldest is None or timestamp < oldest:
+        state['oldest_timestamp'] = tweet['timestamp']
+
+def load_checkpoint(path):
+    """Reads a checkpoint written by save_checkpoint, restoring the job's dates."""
+    with open(path, encoding='utf-8') as f:
+        state = json.load(f)
+    for key in ('start_date', 'end_date'):
+        if state['job'].get(key):
+            state['job'][key] = datetime.date.fromisoformat(state['job'][key])
+    return state
+
+def tweet_watermark(tweet):
+    """Watermark for a tweet record: its status ID and timestamp."""
+    return {'status_id': tweet.get('status_id'), 'timestamp': tweet['timestamp']}
+
+def at_or_below_watermark(tweet, watermark):
+    """True if tweet is not newer than watermark. Compares status IDs (time-ordered snowflakes) when both have one, else timestamps."""
+    if tweet.get('status_id') and watermark.get('status_id'):
+        return int(tweet['status_id']) <= int(watermark['status_id'])
+    return parse_tweet_timestamp(tweet['timestamp']) <= parse_tweet_timestamp(watermark['timestamp'])
+
+def advance_watermark(watermark, newest, keys, complete):
+    """Watermark to save after a watch poll: moved up to the newest tweet if the poll was complete, else kept with the new tweets as 'pending'."""
+    pending = (watermark or {}).get('pending') or {'newest': None, 'keys': []}
+    if newest is None or (pending['newest'] and at_or_below_watermark(newest, pending['newest'])):
+        newest = pending['newest']
+    if complete:
+        if newest is None or (watermark and at_or_below_watermark(newest, watermark)):
+            return watermark and tweet_watermark(watermark)
+        return newest
+    return dict(tweet_watermark(watermark), pending={'newest': newest, 'keys': pending['keys'] + keys})
+
+def load_watermarks(path=WATERMARK_FILE):
+    """Reads the per-query watermarks ({scope: watermark}), or {} if there are none yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_watermark(path, scope, watermark):
+    """Atomically stores the watermark of one query, keeping the others."""
+    watermarks = load_watermarks(path)
+    watermarks[scope] = dict(watermark, updated_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)
+
+def parse_tweet_timestamps(timestamps):
+    """Parses a sequence of tweet timestamps into a datetime64 (UTC) Series in one vectorized call. Bad or missing ones become NaT."""
+    import pandas as pd
+    # format='ISO8601' accepts every ISO form (with or without milliseconds, 'Z' or an offset) in the same column;
+    # otherwise pandas infers one format from the first value and the rest become NaT
+    return pd.to_datetime(pd.Series(timestamps, dtype=object), utc=True, errors='coerce', format='ISO8601')
+
 def filter_by_date(tweets, start_date, end_date):
-    """Filters tweets based on the date range (inclusive)."""
-    filtered_tweets = []
-    start_dt = datetime.datetime.combine(start_date, datetime.datetime.min.time()).replace(tzinfo=datetime.timezone.utc) if start_date else None
-    end_dt = datetime.datetime.combine(end_date, datetime.datetime.max.time()).replace(tzinfo=datetime.timezone.utc) if end_date else None
+    """Filters tweets (records or TweetColumns) to the inclusive date range, comparing timestamps as one datetime64 column."""
+    import pandas as pd
+    # Only the timestamp column is needed to pick the rows of a record list (and it exists even when there are none)
+    columns = tweets if isinstance(tweets, TweetColumns) else TweetColumns.from_records(tweets, fields=['timestamp'])
+    start_dt, end_dt = date_window(start_date, end_date)
+    timestamps = parse_tweet_timestamps(columns['timestamp'])
+    in_range = timestamps.notna()
+    unparsed = len(timestamps) - int(in_range.sum())
+    if unparsed:
+        print(f"Skipping {unparsed} tweets with a missing or unparseable timestamp.")
+    if start_dt:
+        in_range &= timestamps >= pd.Timestamp(start_dt)
+    if end_dt:
+        in_range &= timestamps <= pd.Timestamp(end_dt)
+    keep = in_range.to_numpy().nonzero()[0]
+    if isinstance(tweets, TweetColumns):
+        return tweets.take(keep)
+    return [tweets[i] for i in keep]
 
-    for tweet in tweets:
-        try:
-            if not tweet.get('timestamp'):
-                print(f"Skipping tweet with missing timestamp: {tweet.get('user')}")
+def split_date_range(start_date, end_date, granularity='day'):
+    """Splits the inclusive date range into shard windows, newest first: (date, date) days or (start, exclusive end) UTC hours."""
+    shards = []
+    day = end_date
+    while day >= start_date:
+        if granularity == 'hour':
+            day_start = datetime.datetime.combine(day, datetime.datetime.min.time()).replace(tzinfo=datetime.timezone.utc)
+            for hour in reversed(range(24)):
+                hour_start = day_start + datetime.timedelta(hours=hour)
+                shards.append((hour_start, hour_start + datetime.timedelta(hours=1)))
+        else:
+            shards.append((day, day))
+        day -= datetime.timedelta(days=1)
+    return shards
+
+def _shard_label(shard):
+    since = shard['since']
+    return since.strftime('%Y-%m-%d %H:00') if isinstance(since, datetime.datetime) else since.isoformat()
+
+def _shard_worker(worker_id, worker_accounts, selected_proxy, proxy_pool, job, shard_queue, results, state, driver_options, scrape_options):
+    """Pool worker: logs in once, then scrapes shards from shard_queue into results until none are left."""
+    driver, account_email = open_logged_in_session(worker_accounts, selected_proxy, proxy_pool, **driver_options)
+    if not driver:
+        print(f"[worker {worker_id}] Could not log in with any of its {len(worker_accounts)} accounts. Worker stopped.")
+        with state['lock']:
+            state['live_workers'].discard(worker_id)
+        return
+    print(f"[worker {worker_id}] Logged in as {account_email}.")
+    try:
+        while not state['stop'].is_set():
+            with state['lock']:
+                if state['remaining'] == 0:
+                    break
+            try:
+                shard = shard_queue.get(timeout=1)
+            except queue.Empty:
                 continue
 
-            tweet_dt = datetime.datetime.fromisoformat(tweet['timestamp'].replace('Z', '+00:00'))
+            # A shard that already failed here goes to another live worker, if there is one
+            with state['lock']:
+                other_workers = state['live_workers'] - shard['failed_workers']
+            if worker_id in shard['failed_workers'] and other_workers:
+                shard_queue.put(shard)
+                time.sleep(1)
+                continue
 
-            in_range = True
-            if start_dt and tweet_dt < start_dt:
-                in_range = False
-            if end_dt and tweet_dt > end_dt:
-                in_range = False
+            label = _shard_label(shard)
+            shard['attempts'] += 1
+            print(f"[worker {worker_id}] Shard {label}: starting (attempt {shard['attempts']}/{SHARD_MAX_ATTEMPTS}).")
+            shard_start = time.time()
+            shard_count = 0
+            try:
+                search_url = build_search_url(job['query'], shard['since'], shard['until'], job['mode'], job['search_type'])
+                # A page that never loads raises, so the shard is retried instead of counting as empty
+                with contextlib.closing(iter_tweets(driver, search_url, max_tweets=job['max_tweets'], start_date=shard['since'],
+                                                    end_date=shard['until'], raise_on_load_failure=True, stop_event=state['stop'],
+                                                    proxy_pool=proxy_pool, **scrape_options)) as shard_tweets:
+                    for tweet in shard_tweets:
+                        if state['stop'].is_set():
+                            break
+                        shard_count += 1
+                        results.put(('tweet', label, tweet))
+                if state['stop'].is_set():
+                    break # Stopped mid-shard: it is not done
+                results.put(('done', label, (worker_id, shard_count, time.time() - shard_start)))
+                with state['lock']:
+                    state['remaining'] -= 1
+            except Exception as e:
+                print(f"[worker {worker_id}] Shard {label} failed after {shard_count} tweets: {e}")
+                shard['failed_workers'].add(worker_id)
+                if shard['attempts'] >= SHARD_MAX_ATTEMPTS:
+                    results.put(('failed', label, (worker_id, str(e))))
+                    with state['lock']:
+                        state['remaining'] -= 1
+                else:
+                    shard_queue.put(shard)
+                previous_driver = driver
+                driver = reopen_if_proxy_failed(driver, worker_accounts, proxy_pool, prefix=f"[worker {worker_id}] ", **driver_options)
+                if not driver:
+                    print(f"[worker {worker_id}] Worker stopped.")
+                    break
+                if driver is not previous_driver:
+                    continue
+                try:
+                    driver.title # Make sure the session survived before taking another shard
+                except Exception:
+                    print(f"[worker {worker_id}] Browser session lost. Worker stopped.")
+                    break
+    finally:
+        with state['lock']:
+            state['live_workers'].discard(worker_id)
+        if driver:
+            driver.resource_monitor.report(prefix=f"[worker {worker_id}] ")
+            driver.quit()
+            if proxy_pool:
+                proxy_pool.release(driver.proxy)
 
-            if in_range:
-                filtered_tweets.append(tweet)
-        except ValueError:
-            print(f"Could not parse timestamp '{tweet['timestamp']}' for filtering (ValueError). Skipping tweet.")
-        except Exception as e:
-            print(f"Could not parse timestamp '{tweet['timestamp']}' for filtering: {e}. Skipping tweet.")
+def scrape_sharded(job, accounts, selected_proxy=None, pool_size=SHARD_WORKERS, granularity='day', seen_index=None, driver_options=None,
+                   proxy_pool=None, **scrape_options):
+    """Scrapes job's date range as day/hour shards on a pool of logged-in drivers and yields the merged, deduplicated tweets."""
+    driver_options = dict(driver_options or {}, capture_network=scrape_options.get('extraction_mode') == 'network')
+    if not job['start_date']:
+        raise ValueError("Sharded scraping needs a start date.")
+    end_date = job['end_date'] or datetime.datetime.now(datetime.timezone.utc).date()
+    if seen_index is None:
+        seen_index = TweetIndex()
 
-    return filtered_tweets
+    shard_queue = queue.Queue()
+    for since, until in split_date_range(job['start_date'], end_date, granularity):
+        shard_queue.put({'since': since, 'until': until, 'attempts': 0, 'failed_workers': set()})
+    total_shards = shard_queue.qsize()
+    pool_size = max(1, min(pool_size, len(accounts), total_shards))
+    print(f"Split {job['start_date']}..{end_date} into {total_shards} {granularity} shards across {pool_size} workers.")
 
-# --- Main Execution ---
-if __name__ == "__main__":
-    print("Twitter Scraper")
-    print("---------------")
+    results = queue.Queue()
+    state = {'lock': threading.Lock(), 'stop': threading.Event(), 'remaining': total_shards, 'live_workers': set(range(1, pool_size + 1))}
+    workers = []
+    for worker_id in range(1, pool_size + 1):
+        worker_accounts = accounts[worker_id - 1::pool_size]
+        worker = threading.Thread(target=_shard_worker, name=f"shard-worker-{worker_id}", daemon=True,
+                                  args=(worker_id, worker_accounts, selected_proxy, proxy_pool, job, shard_queue, results, state, driver_options, scrape_options))
+        worker.start()
+        workers.append(worker)
 
-    # --- Proxy Setup ---
-    use_proxy = input("Use proxy? (y/n): ").lower()
-    selected_proxy = None
-    if use_proxy == 'y':
+    merged = 0
+    shards_finished = 0
+    shard_new_tweets = {}
+    try:
+        while merged < job['max_tweets']:
+            try:
+                kind, label, payload = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if kind == 'tweet':
+                if seen_index.add(tweet_key(payload)):
+                    merged += 1
+                    shard_new_tweets[label] = shard_new_tweets.get(label, 0) + 1
+                    yield payload
+            elif kind == 'done':
+                worker_id, shard_count, elapsed = payload
+                shards_finished += 1
+                print(f"[shard {label}] Done on worker {worker_id}: {shard_count} tweets ({shard_new_tweets.get(label, 0)} new after merge) in {elapsed:.0f}s. "
+                      f"{shards_finished}/{total_shards} shards finished, {merged} tweets merged.")
+            else:
+                worker_id, error = payload
+                shards_finished += 1
+                print(f"[shard {label}] Gave up after {SHARD_MAX_ATTEMPTS} attempts (last on worker {worker_id}): {error}")
+    finally:
+        # Workers see the stop at their next pass (or wake from a backoff), close their scrape and quit their browser
+        state['stop'].set()
+        running = [worker for worker in workers if worker.is_alive()]
+        if running:
+            print(f"Stopping {len(running)} shard workers...")
+        for worker in running:
+            worker.join()
+        seen_index.flush()
+
+    with state['lock']:
+        unfinished = state['remaining']
+    if unfinished and merged < job['max_tweets']:
+        print(f"Warning: {unfinished} shards were not scraped because no workers were left.")
+    print(f"Sharded scrape finished. Merged {merged} tweets from {shards_finished}/{total_shards} shards.")
+
+def output_fields_for(extraction_mode, with_media=False):
+    """Output columns for an extraction mode; with_media adds the media/link URLs used by MediaDownloader."""
+    fields = NETWORK_OUTPUT_FIELDS if extraction_mode == 'network' else OUTPUT_FIELDS
+    if with_media:
+        fields = fields + [field for field in MEDIA_FIELDS if field not in fields]
+    return fields
+
+def read_output_records(path):
+    """Reads back a scrape output file (CSV, JSONL, Parquet or Arrow) as tweet records, with list fields as lists."""
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            records = list(csv.DictReader(f))
+        for record in records:
+            for field in MEDIA_FIELDS:
+                record[field] = record[field].split() if record.get(field) else []
+        return records
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    import pyarrow.dataset as ds
+    # Parquet/Arrow outputs are directories of part files (see TweetWriter)
+    table = ds.dataset(path, format='parquet' if path.endswith('.parquet') else 'arrow').to_table()
+    records = table.to_pylist()
+    for record in records:
+        if isinstance(record.get('timestamp'), datetime.datetime):
+            record['timestamp'] = record['timestamp'].strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return records
+
+class MediaDownloader:
+    """Downloads the media and link URLs of scraped tweets on a thread pool into a content-addressed store with a manifest."""
+
+    def __init__(self, out_dir, workers=MEDIA_WORKERS, timeout=MEDIA_TIMEOUT, max_bytes=MEDIA_MAX_BYTES):
+        self.out_dir = out_dir
+        self.manifest_path = os.path.join(out_dir, MEDIA_MANIFEST_FILE)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.local = threading.local() # Per-thread {(scheme, host): connection}
+        self.downloaded = {} # url -> file fields of its download, from the manifest or this run
+        self.linked = set() # (tweet key, url) pairs already in the manifest
+        self.waiting = {} # url being downloaded -> manifest entries waiting for it
+        self.stats = {'downloaded': 0, 'duplicates': 0, 'cached': 0, 'failed': 0, 'bytes': 0}
+        os.makedirs(os.path.join(out_dir, 'files'), exist_ok=True)
+        self.load_manifest()
+        self.manifest = open(self.manifest_path, 'a', encoding='utf-8')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self.slots = threading.BoundedSemaphore(workers * 4) # Queued downloads; submit() blocks when all are taken
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                # Failed downloads and files deleted since are fetched again
+                if entry.get('sha256') and os.path.exists(os.path.join(self.out_dir, entry['file'])):
+                    self.downloaded[entry['url']] = {field: entry[field] for field in ('file', 'sha256', 'bytes', 'content_type', 'final_url')}
+                    self.linked.add((entry['tweet'], entry['url']))
+        print(f"Media cache: {len(self.downloaded)} URLs already downloaded to {self.out_dir}.")
+
+    def write_manifest(self, entries, result):
+        # Called with self.lock held
+        for entry in entries:
+            self.manifest.write(json.dumps(dict(entry, **result), ensure_ascii=False) + '\n')
+        self.manifest.flush()
+
+    def submit(self, tweet):
+        """Queues the tweet's media and link URLs for download, blocking while the pool is full."""
+        for kind, field in (('media', 'media'), ('link', 'links')):
+            for url in tweet.get(field) or []:
+                if not url.startswith(('http://', 'https://')):
+                    continue
+                entry = {'tweet': tweet_key(tweet), 'user': tweet.get('user'), 'timestamp': tweet.get('timestamp'), 'kind': kind, 'url': url}
+                with self.lock:
+                    if (entry['tweet'], url) in self.linked:
+                        continue
+                    self.linked.add((entry['tweet'], url))
+                    if url in self.downloaded:
+                        self.stats['cached'] += 1
+                        self.write_manifest([entry], self.downloaded[url])
+                        continue
+                    if url in self.waiting:
+                        self.waiting[url].append(entry) # Same URL from another tweet: download once
+                        continue
+                    self.waiting[url] = [entry]
+                self.slots.acquire()
+                self.executor.submit(self.download_task, url)
+
+    def download_task(self, url):
+        try:
+            try:
+                result = self.download(url)
+            except Exception as e:
+                result = {'error': f"{type(e).__name__}: {e}"}
+            with self.lock:
+                if 'error' in result:
+                    self.stats['failed'] += 1
+                else:
+                    self.downloaded[url] = result
+                self.write_manifest(self.waiting.pop(url), result)
+        finally:
+            self.slots.release()
+
+    def connection(self, scheme, host):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        connections = self.local.connections
+        if (scheme, host) not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connections[(scheme, host)] = connection_class(host, timeout=self.timeout)
+        return connections[(scheme, host)]
+
+    def drop_connection(self, scheme, host):
+        connection = getattr(self.local, 'connections', {}).pop((scheme, host), None)
+        if connection:
+            connection.close()
+
+    def open(self, url):
+        """GETs url on this thread's connection to its host, following redirects. Returns (response, final URL)."""
+        for _ in range(MEDIA_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            for attempt in range(2):
+                connection = self.connection(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers={'User-Agent': USER_AGENT})
+                    response = connection.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    self.drop_connection(parts.scheme, parts.netloc)
+                    if attempt:
+                        raise # A kept-alive connection the server has closed fails once; a fresh one should not
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                response.read()
+                raise ValueError(f"HTTP {response.status}")
+            return response, url
+        raise ValueError(f"More than {MEDIA_MAX_REDIRECTS} redirects")
+
+    def download(self, url):
+        """Fetches url into the content-addressed store. Returns its manifest fields (file, sha256, bytes, content_type, final_url)."""
+        response, final_url = self.open(url)
+        digest = hashlib.sha256()
+        size = 0
+        parts = urllib.parse.urlsplit(final_url)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.join(self.out_dir, 'files'), suffix='.part', delete=False)
         try:
-            proxy_df = pd.read_csv(PROXY_FILE, delimiter=';')
-            http_proxies = proxy_df[proxy_df['http'] == 1]
-            if not http_proxies.empty:
-                random_proxy = http_proxies.sample(n=1).iloc[0]
-                proxy_ip = random_proxy['ip']
-                proxy_port = random_proxy['port']
-                selected_proxy = f"{proxy_ip}:{proxy_port}"
-                print(f"Using proxy: {selected_proxy}")
+            with tmp:
+                while True:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"larger than {self.max_bytes / 1e6:.0f} MB")
+                    digest.update(chunk)
+                    tmp.write(chunk)
+        except Exception:
+            self.drop_connection(parts.scheme, parts.netloc) # Body not fully read; the connection cannot be reused
+            os.remove(tmp.name)
+            raise
+        sha256 = digest.hexdigest()
+        content_type = (response.getheader('Content-Type') or '').split(';')[0].strip()
+        extension = mimetypes.guess_extension(content_type) or os.path.splitext(parts.path)[1][:8]
+        relative_path = os.path.join('files', sha256[:2], sha256 + extension)
+        path = os.path.join(self.out_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            duplicate = os.path.exists(path)
+            if duplicate:
+                os.remove(tmp.name) # Same content already stored (e.g. one image behind two URLs)
+                self.stats['duplicates'] += 1
             else:
-                print(f"Warning: No valid HTTP proxies found in {PROXY_FILE}. Proceeding without proxy.")
-        except FileNotFoundError:
-            print(f"Warning: Proxy file not found at {PROXY_FILE}. Proceeding without proxy.")
-        except KeyError as e:
-            print(f"Warning: Column {e} not found in {PROXY_FILE}. Check CSV format (ip;port;http). Proceeding without proxy.")
-        except Exception as e:
-            print(f"Warning: Error reading or processing proxy file {PROXY_FILE}: {e}. Proceeding without proxy.")
-    else:
-        print("Proceeding without proxy.")
-    # --- End Proxy Setup ---
+                os.replace(tmp.name, path)
+                self.stats['downloaded'] += 1
+                self.stats['bytes'] += size
+        METRICS.incr('media_bytes', 0 if duplicate else size)
+        return {'file': relative_path, 'sha256': sha256, 'bytes': size, 'content_type': content_type, 'final_url': final_url}
+
+    def close(self):
+        """Waits for the queued downloads, then prints what was fetched."""
+        with METRICS.timer('phase', 'media_drain'):
+            self.executor.shutdown(wait=True)
+        self.manifest.close()
+        stats = self.stats
+        print(f"Media: {stats['downloaded']} files downloaded ({stats['bytes'] / 1e6:.1f} MB), {stats['duplicates']} duplicate contents, "
+              f"{stats['cached']} already cached, {stats['failed']} failed. Manifest: {self.manifest_path}")
+        return stats
+
+LATEST_ONLY_OPTIONS = ('older_tweet_limit', 'recycle_after_passes', 'recycle_memory_mb') # Rely on a time-ordered timeline
+
+def options_for_search_type(scrape_options, search_type):
+    """iter_tweets options for a job: Top searches are not in time order, so LATEST_ONLY_OPTIONS are turned off."""
+    if search_type == 'latest':
+        return dict(scrape_options)
+    if scrape_options.get('recycle_after_passes') or scrape_options.get('recycle_memory_mb'):
+        print("Warning: Page recycling only works on Latest searches (its until: bound would drop newer Top tweets). Disabled for this job.")
+    return dict(scrape_options, **{option: None for option in LATEST_ONLY_OPTIONS})
+
+def job_scope(job):
+    """Scope of a job's keys in SEEN_DB_FILE and WATERMARK_FILE: its mode and lowercased query."""
+    return f"{job['mode']}:{job['query'].lower()}"
+
+def job_seen_index(job):
+    """Dedup index for a job: persistent under job_scope with skip_seen (committed by write_tweets), else in memory."""
+    return TweetIndex(SEEN_DB_FILE, scope=job_scope(job), commit_every=None) if job['skip_seen'] else TweetIndex()
 
+def write_tweets(tweets, writer, seen_index, media_downloader=None, on_tweet=None, on_flush=None):
+    """Writes tweets and queues their media, committing seen_index (then calling on_flush) after each writer flush; always closes tweets."""
+    with contextlib.closing(tweets):
+        for tweet in tweets:
+            if on_tweet:
+                on_tweet(tweet)
+            flushed = writer.write(tweet)
+            if media_downloader:
+                media_downloader.submit(tweet)
+            if flushed:
+                seen_index.flush()
+                if on_flush:
+                    on_flush()
+
+def default_output_filename(job, output_format='csv'):
+    """Output file name used when a job does not name one."""
+    safe_query = "".join(c if c.isalnum() else "_" for c in job['query'])
+    return f"twitter_scrape_{job['mode']}_{safe_query}.{output_format}"
+
+def load_jobs(path):
+    """Reads a batch job file (a JSON list of jobs, or {"defaults": {...}, "jobs": [...]}) and returns validated job dicts."""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    defaults = data.get('defaults', {}) if isinstance(data, dict) else {}
+    raw_jobs = data.get('jobs', []) if isinstance(data, dict) else data
+
+    jobs = []
+    for number, raw_job in enumerate(raw_jobs, 1):
+        job = dict(defaults, **raw_job)
+        if job.get('mode') not in ('hashtag', 'message', 'user'):
+            raise ValueError(f"Job {number}: mode must be hashtag, message or user (got {job.get('mode')!r})")
+        if not job.get('query'):
+            raise ValueError(f"Job {number}: missing query")
+        for key in ('start_date', 'end_date'):
+            job[key] = datetime.datetime.strptime(job[key], '%Y-%m-%d').date() if job.get(key) else None
+        if job['start_date'] and job['end_date'] and job['end_date'] < job['start_date']:
+            raise ValueError(f"Job {number}: end_date is before start_date")
+        job['search_type'] = 'top' if job['mode'] != 'user' and str(job.get('search_type', '')).lower() == 'top' else 'latest'
+        job['max_tweets'] = int(job.get('max_tweets', 100))
+        job['skip_seen'] = bool(job.get('skip_seen', False))
+        jobs.append(job)
+    if not jobs:
+        raise ValueError("No jobs listed")
+    return jobs
+
+def job_output_files(jobs, output_format='csv'):
+    """Output file of each job: its 'output', or the default name, made unique with the job number when two collide."""
+    output_files = []
+    for number, job in enumerate(jobs, 1):
+        output_file = job.get('output') or default_output_filename(job, output_format)
+        if output_file in output_files:
+            root, ext = os.path.splitext(output_file)
+            output_file = f"{root}_{number}{ext}"
+        output_files.append(output_file)
+    return output_files
+
+def run_batch(driver, jobs, output_format='csv', media_downloader=None, accounts=None, proxy_pool=None, driver_options=None,
+              **scrape_options):
+    """Runs jobs back to back on one logged-in driver, each to its own output file, and returns their summaries."""
+    output_fields = output_fields_for(scrape_options.get('extraction_mode'), with_media=media_downloader is not None)
+    summaries = []
     try:
-        accounts_df = pd.read_csv(ACCOUNTS_FILE)
-        accounts_df['username'] = accounts_df['username'].fillna('')
-        accounts = accounts_df.to_dict('records')
-        if not accounts:
-            print(f"Error: No accounts found in {ACCOUNTS_FILE}. Please check the file.")
-            exit()
-        print(f"Loaded {len(accounts)} accounts from {ACCOUNTS_FILE}.")
-    except FileNotFoundError:
-        print(f"Error: Accounts file not found at {ACCOUNTS_FILE}")
-        print("Please create an accounts.csv file with columns: email,username,password")
-        exit()
-    except Exception as e:
-        print(f"Error reading accounts file {ACCOUNTS_FILE}: {e}")
-        exit()
+        for number, (job, output_file) in enumerate(zip(jobs, job_output_files(jobs, output_format)), 1):
+            print("=" * 20)
+            print(f"Job {number}/{len(jobs)}: {job['mode']} '{job['query']}' (Type: {job['search_type'].capitalize()}) -> {output_file}")
+            job_options = options_for_search_type(scrape_options, job['search_type'])
+            seen_index = job_seen_index(job)
+            writer = TweetWriter(output_file, output_format, fields=output_fields)
+            status = 'ok'
+            job_start = time.time()
+            try:
+                search_url = build_search_url(job['query'], job['start_date'], job['end_date'], job['mode'], job['search_type'])
+                # A page that never loads (e.g. a dead proxy's error page) fails the job, so the proxy is rechecked
+                tweets = iter_tweets(driver, search_url, max_tweets=job['max_tweets'], seen_index=seen_index,
+                                     start_date=job['start_date'], end_date=job['end_date'], raise_on_load_failure=True,
+                                     proxy_pool=proxy_pool, **job_options)
+                write_tweets(tweets, writer, seen_index, media_downloader)
+            except Exception as e:
+                status = f"failed: {e}"
+                print(f"Job {number} failed: {e}")
+                driver = reopen_if_proxy_failed(driver, accounts, proxy_pool, **(driver_options or {}))
+            finally:
+                writer.close()
+                seen_index.close()
+            elapsed = time.time() - job_start
+            summaries.append({
+                'job': number,
+                'mode': job['mode'],
+                'query': job['query'],
+                'output': output_file,
+                'tweets': writer.count,
+                'seconds': elapsed,
+                'tweets_per_sec': writer.count / elapsed if elapsed else 0,
+                'status': status,
+            })
+            print(f"Job {number} finished: {writer.count} tweets in {elapsed:.1f}s.")
+            if not driver:
+                print("No browser session left. Skipping the remaining jobs.")
+                break
+    finally:
+        if driver:
+            driver.resource_monitor.report()
+            print("Closing WebDriver (Edge).")
+            driver.quit()
+
+    print("=" * 20)
+    print("Batch summary:")
+    for summary in summaries:
+        print(f"  #{summary['job']} {summary['mode']:<8} {summary['query'][:30]:<30} {summary['tweets']:>6} tweets "
+              f"{summary['seconds']:>8.1f}s {summary['tweets_per_sec']:>7.2f} tweets/sec  {summary['status']}")
+    total_tweets = sum(summary['tweets'] for summary in summaries)
+    total_seconds = sum(summary['seconds'] for summary in summaries)
+    print(f"  Total: {total_tweets} tweets in {total_seconds:.1f}s ({total_tweets / total_seconds if total_seconds else 0:.2f} tweets/sec)")
+    return summaries
+
+def watch_jobs(driver, jobs, interval_sec=WATCH_INTERVAL_MIN * 60, output_format='csv', watermark_path=WATERMARK_FILE, media_downloader=None,
+               accounts=None, proxy_pool=None, driver_options=None, **scrape_options):
+    """Polls every job's Latest search each interval_sec, appending the tweets newer than its watermark, until interrupted."""
+    output_fields = output_fields_for(scrape_options.get('extraction_mode'), with_media=media_downloader is not None)
+    scrape_options = dict(scrape_options, older_tweet_limit=None) # The watermark ends each poll instead
+    output_files = job_output_files(jobs, output_format)
+    totals = [0] * len(jobs)
+    poll = 0
+    print(f"Watching {len(jobs)} queries every {interval_sec / 60:g} minutes. Press Ctrl+C to stop.")
+    try:
+        while driver:
+            poll += 1
+            poll_start = time.time()
+            for number, (job, output_file) in enumerate(zip(jobs, output_files), 1):
+                scope = job_scope(job)
+                watermark = load_watermarks(watermark_path).get(scope)
+                pending_keys = (watermark.get('pending') or {}).get('keys', []) if watermark else []
+                print("=" * 20)
+                since_text = f"since {watermark.get('status_id') or watermark['timestamp']}" if watermark else "first poll"
+                if pending_keys:
+                    since_text += f", {len(pending_keys)} newer tweets already collected"
+                print(f"Poll {poll}, job {number}/{len(jobs)}: {job['mode']} '{job['query']}' ({since_text}) -> {output_file}")
+                seen_index = job_seen_index(job)
+                for key in pending_keys:
+                    seen_index.add(key)
+                writer = TweetWriter(output_file, output_format, fields=output_fields)
+                collected = [] # (key, watermark) of every tweet written by this poll
+                outcome = {}
+                try:
+                    search_url = build_search_url(job['query'], None if watermark else job['start_date'], None, job['mode'], 'latest')
+                    tweets = iter_tweets(driver, search_url, max_tweets=job['max_tweets'], seen_index=seen_index,
+                                         watermark=watermark, raise_on_load_failure=True, outcome=outcome, proxy_pool=proxy_pool,
+                                         **scrape_options)
+                    write_tweets(tweets, writer, seen_index, media_downloader,
+                                 on_tweet=lambda tweet: collected.append((tweet_key(tweet), tweet_watermark(tweet))))
+                except Exception as e:
+                    print(f"Poll {poll} of job {number} failed: {e}")
+                    driver = reopen_if_proxy_failed(driver, accounts, proxy_pool, **(driver_options or {}))
+                finally:
+                    writer.close()
+                    seen_index.close()
+                    # Saved even after a failure or Ctrl+C: the collected tweets are on disk
+                    keys = [key for key, _ in collected]
+                    newest = None
+                    for _, tweet_mark in collected:
+                        if newest is None or not at_or_below_watermark(tweet_mark, newest):
+                            newest = tweet_mark
+                    complete = watermark is None or outcome.get('stop_reason') in ('watermark', 'end')
+                    if keys or (complete and pending_keys):
+                        save_watermark(watermark_path, scope, advance_watermark(watermark, newest, keys, complete))
+                totals[number - 1] += writer.count
+                print(f"Poll {poll}, job {number}: {writer.count} new tweets ({totals[number - 1]} since watching started).")
+                if not driver:
+                    print("No browser session left. Stopping watch mode.")
+                    break
+            if not driver:
+                break
+
+            try:
+                driver.title # Make sure the session survived before sleeping until the next poll
+            except Exception:
+                print("Browser session lost. Stopping watch mode.")
+                break
+            next_poll_in = interval_sec - (time.time() - poll_start)
+            print(f"Next poll in {max(0, next_poll_in) / 60:.1f} minutes.")
+            if next_poll_in > 0:
+                time.sleep(next_poll_in)
+    except KeyboardInterrupt:
+        print("\nWatch mode stopped.")
+    finally:
+        if driver:
+            driver.resource_monitor.report()
+            print("Closing WebDriver (Edge).")
+            driver.quit()
+    print(f"Watched {poll} polls: {sum(totals)} new tweets in total.")
+    return totals
 
+def prompt_for_job():
+    """Interactively asks for the query parameters of one scrape job and returns them as a dict."""
+    mark_startup('first_prompt')
     mode = input("Select mode (hashtag, message, user): ").lower()
     while mode not in ['hashtag', 'message', 'user']:
         print("Invalid mode.")
@@ -385,97 +2322,314 @@ if __name__ == "__main__":
         print("Invalid number, defaulting to 100.")
         max_tweets = 100
 
-    driver = None
-    login_successful = False
-    for account in accounts:
-        print("-" * 20)
-        print("Initializing WebDriver (Edge)...")
-        options = EdgeOptions()
-        options.use_chromium = True
-        # Stealth Options (Keep existing and add more)
-        options.add_argument("--disable-blink-features=AutomationControlled")
-        options.add_experimental_option("excludeSwitches", ["enable-automation", "enable-logging"])
-        options.add_experimental_option('useAutomationExtension', False)
-        options.add_argument("--incognito")
-        options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-        options.add_argument("--lang=en-US") # Set language
-        options.add_argument("--disable-infobars") # Disable "Chrome is being controlled..." bar
-        options.add_argument("--start-maximized") # Start maximized
-        options.add_argument("--disable-extensions") # Disable extensions
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-gpu') # Sometimes helps with stability/detection
+    skip_seen = input("Skip tweets already collected by previous runs of this query? (y/n): ").lower() == 'y'
+
+    return {
+        'mode': mode,
+        'query': query,
+        'search_type': search_type,
+        'start_date': start_date,
+        'end_date': end_date,
+        'max_tweets': max_tweets,
+        'skip_seen': skip_seen,
+    }
 
-        if selected_proxy:
-            options.add_argument(f'--proxy-server={selected_proxy}')
-            print(f"WebDriver configured to use proxy: {selected_proxy}")
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Twitter Scraper")
+    parser.add_argument('--resume', nargs='?', const=CHECKPOINT_FILE, metavar='CHECKPOINT',
+                        help=f"Continue an interrupted run from its checkpoint (default: {CHECKPOINT_FILE})")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv',
+                        help="Output format (default: csv). parquet/arrow need pyarrow and are written as a directory of part files")
+    parser.add_argument('--older-tweet-limit', type=int, default=OLDER_TWEET_LIMIT,
+                        help=f"Stop Latest scrolling after this many consecutive tweets older than the start date (default: {OLDER_TWEET_LIMIT}, 0 disables)")
+    parser.add_argument('--shard', choices=['day', 'hour'],
+                        help="Split the date range into day/hour windows scraped concurrently by a pool of logged-in browsers")
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS,
+                        help=f"Browser sessions used with --shard, at most one per account (default: {SHARD_WORKERS})")
+    parser.add_argument('--extraction', choices=sorted(EXTRACTION_MODES), default='batched',
+                        help="How tweets are read: 'batched' DOM script (default), legacy per-'element' DOM calls, or captured 'network' responses")
+    parser.add_argument('--record-responses', metavar='DIR',
+                        help="With --extraction network, save captured timeline responses to DIR as offline fixtures")
+    parser.add_argument('--profile', choices=['default', 'lean'], default='default',
+                        help="Browser profile: 'default' (maximized, full page) or 'lean' (headless, small viewport, no images/media/fonts)")
+    parser.add_argument('--scroll-wait', choices=['event', 'sleep'], default='event',
+                        help="After scrolling, continue as soon as new tweets render ('event', default) or sleep a fixed random pause ('sleep')")
+    parser.add_argument('--min-scroll-delay', type=float, default=MIN_SCROLL_DELAY,
+                        help=f"Minimum seconds between scrolls with --scroll-wait event (default: {MIN_SCROLL_DELAY})")
+    parser.add_argument('--recycle-passes', type=int, metavar='N',
+                        help="Long runs: reload the search (until: the oldest tweet collected) every N scroll passes")
+    parser.add_argument('--recycle-memory-mb', type=float, metavar='MB',
+                        help="Long runs: reload the search once the page's JS heap reaches MB")
+    parser.add_argument('--jobs', metavar='FILE',
+                        help="Batch mode: run every job in this JSON file back to back on one logged-in browser, without prompts")
+    parser.add_argument('--watch', nargs='?', type=float, const=WATCH_INTERVAL_MIN, metavar='MINUTES',
+                        help=f"Poll the query (or every --jobs query) for new tweets every MINUTES (default: {WATCH_INTERVAL_MIN}) "
+                             f"on one browser session, stopping each poll at the newest tweet already collected ({WATERMARK_FILE})")
+    parser.add_argument('--driver-path', default=EDGE_DRIVER_PATH, metavar='PATH',
+                        help="Local msedgedriver to fall back to when the driver cannot be resolved online (default: $EDGE_DRIVER_PATH)")
+    parser.add_argument('--download-media', metavar='DIR',
+                        help="Record media and outbound link URLs and download them to DIR in the background, with a manifest linking files to tweets")
+    parser.add_argument('--media-workers', type=int, default=MEDIA_WORKERS,
+                        help=f"Parallel downloads with --download-media (default: {MEDIA_WORKERS})")
+    parser.add_argument('--media-from', metavar='OUTPUT_FILE',
+                        help="Only run the download stage for the tweets in an earlier output file (resumes from DIR's manifest)")
+    parser.add_argument('--use-proxy', action='store_true', help="Use a proxy from the proxy list without asking")
+    parser.add_argument('--proxy-probe-url', default=PROXY_PROBE_URL, metavar='URL',
+                        help=f"URL fetched through each proxy to rank them by latency and success rate (default: {PROXY_PROBE_URL})")
+    parser.add_argument('--reprobe-proxies', action='store_true',
+                        help=f"Probe every proxy again instead of reusing results cached in {PROXY_HEALTH_FILE}")
+    parser.add_argument('--log-level', choices=['info', 'debug'], default=LOG_LEVEL,
+                        help="'debug' also prints every collected tweet (slower on long runs)")
+    parser.add_argument('--metrics-json', default=RUN_REPORT_FILE, metavar='PATH',
+                        help=f"Where to write the JSON run report with phase/WebDriver timings (default: {RUN_REPORT_FILE})")
+    parser.add_argument('--metrics-prom', metavar='PATH', help="Also write the run metrics in Prometheus text format")
+    args = parser.parse_args()
+    NETWORK_RECORD_DIR = args.record_responses
+    EDGE_DRIVER_PATH = args.driver_path
+    LOG_LEVEL = args.log_level
+    if args.format in COLUMNAR_FORMATS and not PYARROW_AVAILABLE:
+        print(f"Error: --format {args.format} needs pyarrow. Install it with: pip install pyarrow")
+        exit()
 
+    print("Twitter Scraper")
+    print("---------------")
+
+    if args.media_from:
+        if not args.download_media:
+            print("Error: --media-from needs --download-media DIR.")
+            exit()
         try:
-            service = EdgeService(EdgeChromiumDriverManager().install())
-            driver = webdriver.Edge(service=service, options=options)
-            driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-            print("WebDriver (Edge) initialized with enhanced options.")
-
-            # --- NUOVO RITARDO INIZIALE ---
-            initial_delay = random.uniform(5, 10) # Attendi tra 5 e 10 secondi
-            print(f"Waiting for {initial_delay:.1f} seconds before loading login page...")
-            time.sleep(initial_delay)
-            # --- FINE NUOVO RITARDO ---
-
-            if login_to_twitter(driver, account['email'], account.get('username'), account['password']):
-                login_successful = True
-                logged_in_account = account['email']
-                print(f"Login successful with {logged_in_account}. Proceeding to scrape...")
-                break
-            else:
-                print(f"Login failed for {account['email']}. Possible CAPTCHA or incorrect credentials.")
-                print("\n>>> ATTENZIONE: Login fallito. <<<")
-                print(">>> Se è apparso un CAPTCHA, prova a risolverlo manualmente nel browser ora. <<<")
-                print(">>> Lo script attenderà 60 secondi prima di chiudere questo browser e provare l'account successivo. <<<\n")
-                time.sleep(60)
-                print("Timeout scaduto o CAPTCHA non risolto. Provo l'account successivo...")
-                if driver:
-                    driver.quit()
-                driver = None
+            records = read_output_records(args.media_from)
+        except FileNotFoundError:
+            print(f"Error: Output file not found at {args.media_from}")
+            exit()
+        print(f"Downloading the media and links of {len(records)} tweets from {args.media_from} to {args.download_media}...")
+        media_downloader = MediaDownloader(args.download_media, workers=args.media_workers)
+        try:
+            for record in records:
+                media_downloader.submit(record)
+        finally:
+            media_downloader.close()
+            METRICS.export(args.metrics_json, args.metrics_prom)
+        exit()
+
+    checkpoint = None
+    if args.resume:
+        try:
+            checkpoint = load_checkpoint(args.resume)
+            print(f"Resuming '{checkpoint['job']['query']}' from {args.resume}: {checkpoint['count']} tweets already scraped.")
+        except FileNotFoundError:
+            print(f"Error: Checkpoint file not found at {args.resume}")
+            exit()
+        except (ValueError, KeyError) as e:
+            print(f"Error reading checkpoint {args.resume}: {e}")
+            exit()
 
+    batch_jobs = None
+    if args.jobs:
+        try:
+            batch_jobs = load_jobs(args.jobs)
+            print(f"Loaded {len(batch_jobs)} jobs from {args.jobs}.")
+        except FileNotFoundError:
+            print(f"Error: Job file not found at {args.jobs}")
+            exit()
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f"Error reading job file {args.jobs}: {e}")
+            exit()
+
+    # --- Proxy Setup ---
+    if args.use_proxy or batch_jobs:
+        use_proxy = 'y' if args.use_proxy else 'n' # Batch runs never prompt
+    else:
+        mark_startup('first_prompt')
+        use_proxy = input("Use proxy? (y/n): ").lower()
+    proxy_pool = None
+    if use_proxy == 'y':
+        try:
+            http_proxies = load_proxy_list(PROXY_FILE)
+            if http_proxies:
+                proxy_pool = ProxyPool(http_proxies, probe_url=args.proxy_probe_url)
+                if not proxy_pool.probe(force=args.reprobe_proxies):
+                    print(f"Warning: None of the {len(http_proxies)} proxies in {PROXY_FILE} answered. Proceeding without proxy.")
+                    proxy_pool = None
+            else:
+                print(f"Warning: No valid HTTP proxies found in {PROXY_FILE}. Proceeding without proxy.")
+        except FileNotFoundError:
+            print(f"Warning: Proxy file not found at {PROXY_FILE}. Proceeding without proxy.")
+        except KeyError as e:
+            print(f"Warning: Column {e} not found in {PROXY_FILE}. Check CSV format (ip;port;http). Proceeding without proxy.")
         except Exception as e:
-            print(f"An error occurred setting up WebDriver or during login for {account['email']}: {e}")
-            if driver:
-                driver.quit()
-            driver = None
-            continue
+            print(f"Warning: Error reading or processing proxy file {PROXY_FILE}: {e}. Proceeding without proxy.")
+    else:
+        print("Proceeding without proxy.")
+    # --- End Proxy Setup ---
 
-    if not login_successful or not driver:
-        print("-" * 20)
-        print("Exiting: Could not log in with any of the provided accounts.")
+    try:
+        # csv rather than pandas: this runs before the first prompt, and pandas is only needed for filtering later
+        with open(ACCOUNTS_FILE, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            if 'email' not in (reader.fieldnames or []) or 'password' not in reader.fieldnames:
+                raise KeyError("columns 'email' and 'password' are required")
+            accounts = [dict(account, username=account.get('username') or '') for account in reader if account.get('email')]
+        if not accounts:
+            print(f"Error: No accounts found in {ACCOUNTS_FILE}. Please check the file.")
+            exit()
+        print(f"Loaded {len(accounts)} accounts from {ACCOUNTS_FILE}.")
+    except FileNotFoundError:
+        print(f"Error: Accounts file not found at {ACCOUNTS_FILE}")
+        print("Please create an accounts.csv file with columns: email,username,password")
         exit()
+    except Exception as e:
+        print(f"Error reading accounts file {ACCOUNTS_FILE}: {e}")
+        exit()
+
+    scrape_options = {
+        'older_tweet_limit': args.older_tweet_limit,
+        'extraction_mode': args.extraction,
+        'scroll_wait': args.scroll_wait,
+        'min_scroll_delay': args.min_scroll_delay,
+        'recycle_after_passes': args.recycle_passes,
+        'recycle_memory_mb': args.recycle_memory_mb,
+        'collect_media': bool(args.download_media),
+    }
 
+    media_downloader = MediaDownloader(args.download_media, workers=args.media_workers) if args.download_media else None
+    if args.watch and not batch_jobs:
+        batch_jobs = [prompt_for_job()]
+    if batch_jobs:
+        driver_options = {'capture_network': args.extraction == 'network', 'profile': args.profile}
+        driver, logged_in_account = open_logged_in_session(accounts, proxy_pool=proxy_pool, **driver_options)
+        if not driver:
+            print("-" * 20)
+            print("Exiting: Could not log in with any of the provided accounts.")
+            exit()
+        session_options = {'media_downloader': media_downloader, 'accounts': accounts, 'proxy_pool': proxy_pool, 'driver_options': driver_options}
+        try:
+            # Both quit the driver (or the one that replaced it after a proxy failure) when they end
+            if args.watch:
+                watch_jobs(driver, batch_jobs, args.watch * 60, args.format, **session_options, **scrape_options)
+            else:
+                run_batch(driver, batch_jobs, args.format, **session_options, **scrape_options)
+        finally:
+            if media_downloader:
+                media_downloader.close()
+            METRICS.export(args.metrics_json, args.metrics_prom)
+        exit()
+
+    job = checkpoint['job'] if checkpoint else prompt_for_job()
+    checkpoint_path = args.resume or CHECKPOINT_FILE
+    # A sharded run's oldest timestamp comes from its oldest shard while newer shards may be unfinished, so it
+    # resumes sharded too (an until: bound at that timestamp would skip them)
+    shard = args.shard or (checkpoint.get('shard') if checkpoint else None)
+    if checkpoint and shard and not args.shard:
+        print(f"Resuming as a sharded run ({shard} shards), like the interrupted one.")
+    if shard and not job['start_date']:
+        print("Error: --shard needs a start date to split the range into shards.")
+        exit()
+
+    driver = None
+    if not shard:
+        driver, logged_in_account = open_logged_in_session(accounts, proxy_pool=proxy_pool, capture_network=args.extraction == 'network', profile=args.profile)
+        if not driver:
+            print("-" * 20)
+            print("Exiting: Could not log in with any of the provided accounts.")
+            exit()
+
+    if checkpoint:
+        run_state = checkpoint
+    else:
+        run_state = {
+            'job': job,
+            'output_file': default_output_filename(job, args.format),
+            'output_format': args.format,
+            'fields': output_fields_for(args.extraction, with_media=media_downloader is not None),
+            'shard': shard,
+            'count': 0,
+            'oldest_timestamp': None,
+            'seen_keys': [],
+        }
+    start_date, end_date = job['start_date'], job['end_date']
+    seen_index = None
+    writer = None
+    completed = False
     try:
-        search_url = build_search_url(query, start_date, end_date, mode, search_type)
-        print(f"Starting scrape for '{query}' (Type: {search_type.capitalize()})...")
-        scraped_tweets = scrape_tweets(driver, search_url, max_tweets=max_tweets)
-        print(f"Scraped {len(scraped_tweets)} tweets initially.")
-
-        if start_date or end_date:
-            print("Filtering tweets by precise date range...")
-            final_tweets = filter_by_date(scraped_tweets, start_date, end_date)
-            print(f"Filtered down to {len(final_tweets)} tweets within the specified date range.")
-        else:
-            final_tweets = scraped_tweets
-
-        if final_tweets:
-            df = pd.DataFrame(final_tweets)
-            safe_query = "".join(c if c.isalnum() else "_" for c in query)
-            output_filename = f"twitter_scrape_{mode}_{safe_query}.csv"
-            df.to_csv(output_filename, index=False, encoding='utf-8-sig')
-            print(f"Results saved to {output_filename}")
+        until_bound = end_date
+        # Only Latest is in time order; Top and sharded runs search their whole range again on resume
+        resume_from_oldest = job['search_type'] == 'latest' and not shard
+        if run_state['oldest_timestamp'] and resume_from_oldest:
+            # Everything newer than the oldest saved tweet is already on disk; the dedup keys cover that same second.
+            until_bound = parse_tweet_timestamp(run_state['oldest_timestamp']) + datetime.timedelta(seconds=1)
+        print(f"Starting scrape for '{job['query']}' (Type: {job['search_type'].capitalize()})...")
+        seen_index = job_seen_index(job)
+        for key in run_state['seen_keys']:
+            seen_index.add(key)
+        run_state['shard'] = shard
+        if not resume_from_oldest and checkpoint and os.path.exists(run_state['output_file']):
+            # The whole range is searched again: skip every tweet already in the output, not just the oldest second
+            for record in read_output_records(run_state['output_file']):
+                seen_index.add(tweet_key(record))
+        # A resumed run keeps the columns of its output file, whatever --extraction/--download-media say now
+        output_fields = run_state.get('fields') or output_fields_for(args.extraction, with_media=media_downloader is not None)
+        if output_fields != output_fields_for(args.extraction, with_media=media_downloader is not None):
+            print(f"Keeping the columns of {run_state['output_file']}: {', '.join(output_fields)}")
+        writer = TweetWriter(run_state['output_file'], run_state['output_format'], fields=output_fields)
+
+        scrape_options = options_for_search_type(scrape_options, job['search_type'])
+        while True:
+            remaining = job['max_tweets'] - run_state['count']
+            if shard:
+                # Shards cover the whole range again on resume; the restored dedup keys skip what is already saved
+                tweets = scrape_sharded(dict(job, max_tweets=remaining), accounts, pool_size=args.workers, granularity=shard,
+                                        seen_index=seen_index, driver_options={'profile': args.profile}, proxy_pool=proxy_pool,
+                                        **scrape_options)
+            else:
+                search_url = build_search_url(job['query'], start_date, until_bound, job['mode'], job['search_type'])
+                tweets = iter_tweets(driver, search_url, max_tweets=remaining, seen_index=seen_index,
+                                     start_date=start_date, end_date=end_date, proxy_pool=proxy_pool, **scrape_options)
+            try:
+                # Closes tweets even if writing fails, so scrape_sharded stops its workers and their browsers.
+                # Checkpoints follow the writer's flushes: only then is everything counted in run_state on disk.
+                write_tweets(tweets, writer, seen_index, media_downloader, on_tweet=lambda tweet: record_in_checkpoint(run_state, tweet),
+                             on_flush=lambda: save_checkpoint(checkpoint_path, run_state))
+                break
+            except Exception as e:
+                if shard or not proxy_pool: # Shard workers move off failing proxies themselves
+                    raise
+                print(f"Scrape failed: {e}")
+                previous_driver = driver
+                driver = reopen_if_proxy_failed(driver, accounts, proxy_pool, capture_network=args.extraction == 'network', profile=args.profile)
+                if driver is None or driver is previous_driver:
+                    raise
+                # Go on where the failed session stopped; the dedup index holds every tweet collected so far
+                if resume_from_oldest and run_state['oldest_timestamp']:
+                    until_bound = parse_tweet_timestamp(run_state['oldest_timestamp']) + datetime.timedelta(seconds=1)
+                print("Continuing the scrape on the new session...")
+        completed = True
+
+        print(f"Scraped {run_state['count']} tweets in total.")
+        if writer.count or checkpoint:
+            print(f"Results saved to {run_state['output_file']} ({writer.count} new tweets this run)")
         else:
             print("No tweets found matching the criteria.")
 
     except Exception as e:
         print(f"An error occurred during scraping or saving: {e}")
     finally:
+        if writer:
+            writer.close()
+        if completed:
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+        elif run_state['count']:
+            save_checkpoint(checkpoint_path, run_state)
+            print(f"Progress checkpointed to {checkpoint_path}. Re-run with --resume to continue.")
+        if seen_index:
+            seen_index.close()
         if driver:
+            driver.resource_monitor.report()
             print("Closing WebDriver (Edge).")
             driver.quit()
-
+        if media_downloader:
+            media_downloader.close()
+        METRICS.export(args.metrics_json, args.metrics_prom)
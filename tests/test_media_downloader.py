@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import scraper
+
+IMAGE = b'\x89PNG\r\n\x1a\n' + b'pixels' * 2000
+
+
+class MediaServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MediaHandler)
+        self.requests = []
+        self.connections = set()
+        self.base_url = f"http://127.0.0.1:{self.server_port}"
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, as the CDN
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.connections.add(self.client_address)
+        if self.path.startswith('/redirect/'):
+            self.reply(302, headers={'Location': '/media/' + self.path[len('/redirect/'):]})
+        elif self.path.startswith('/media/same'):
+            self.reply(200, IMAGE, {'Content-Type': 'image/png'}) # Every /media/same* URL serves the same bytes
+        elif self.path.startswith('/media/'):
+            self.reply(200, self.path.encode() * 100, {'Content-Type': 'image/jpeg'})
+        else:
+            self.reply(404)
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = MediaServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, scraper.MEDIA_MANIFEST_FILE), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def tweet(status_id, media=(), links=()):
+    return {'user': '@someone', 'timestamp': '2024-02-21T09:15:42.000Z', 'status_id': status_id,
+            'media': list(media), 'links': list(links)}
+
+
+def test_downloads_into_content_addressed_store_with_manifest(server, tmp_path):
+    out_dir = str(tmp_path / 'media')
+    downloader = scraper.MediaDownloader(out_dir, workers=2)
+    downloader.submit(tweet('1', media=[f"{server.base_url}/media/same-a.png", 'blob:https://x.com/video'],
+                            links=[f"{server.base_url}/redirect/page1", f"{server.base_url}/missing"]))
+    downloader.submit(tweet('2', media=[f"{server.base_url}/media/same-b.png"]))
+    stats = downloader.close()
+
+    assert stats['downloaded'] == 2 # same-a and the redirect target
+    assert stats['duplicates'] == 1 # same-b has the same bytes as same-a
+    assert stats['failed'] == 1 # 404
+    entries = {(entry['tweet'], entry['url']): entry for entry in read_manifest(out_dir)}
+    assert len(entries) == 4 # blob: URLs are skipped
+
+    same_a = entries[('1', f"{server.base_url}/media/same-a.png")]
+    same_b = entries[('2', f"{server.base_url}/media/same-b.png")]
+    sha256 = hashlib.sha256(IMAGE).hexdigest()
+    assert same_a['file'] == same_b['file'] == os.path.join('files', sha256[:2], sha256 + '.png')
+    with open(os.path.join(out_dir, same_a['file']), 'rb') as f:
+        assert f.read() == IMAGE
+    assert same_a['kind'] == 'media' and same_a['bytes'] == len(IMAGE) and same_a['content_type'] == 'image/png'
+
+    redirected = entries[('1', f"{server.base_url}/redirect/page1")]
+    assert redirected['kind'] == 'link'
+    assert redirected['final_url'] == f"{server.base_url}/media/page1"
+    assert entries[('1', f"{server.base_url}/missing")]['error'] == 'ValueError: HTTP 404'
+
+
+def test_same_url_from_several_tweets_is_fetched_once(server, tmp_path):
+    url = f"{server.base_url}/media/shared.jpg"
+    downloader = scraper.MediaDownloader(str(tmp_path / 'media'), workers=4)
+    for status_id in range(20):
+        downloader.submit(tweet(str(status_id), media=[url]))
+    downloader.close()
+
+    assert server.requests.count('/media/shared.jpg') == 1
+    assert sorted(entry['tweet'] for entry in read_manifest(str(tmp_path / 'media'))) == sorted(str(i) for i in range(20))
+
+
+def test_workers_reuse_keep_alive_connections(server, tmp_path):
+    downloader = scraper.MediaDownloader(str(tmp_path / 'media'), workers=2)
+    for status_id in range(30):
+        downloader.submit(tweet(str(status_id), media=[f"{server.base_url}/media/photo{status_id}.jpg"]))
+    stats = downloader.close()
+
+    assert stats['downloaded'] == 30
+    assert len(server.connections) <= 2 # One connection per worker thread, not per download
+
+
+def test_manifest_resumes_without_fetching_again(server, tmp_path):
+    out_dir = str(tmp_path / 'media')
+    tweets = [tweet(str(i), media=[f"{server.base_url}/media/photo{i}.jpg"]) for i in range(5)]
+    tweets.append(tweet('5', links=[f"{server.base_url}/missing"]))
+    downloader = scraper.MediaDownloader(out_dir, workers=2)
+    for record in tweets[:3] + tweets[5:]:
+        downloader.submit(record)
+    downloader.close()
+    server.requests.clear()
+
+    downloader = scraper.MediaDownloader(out_dir, workers=2) # An interrupted run submits everything again
+    for record in tweets + [tweet('6', media=[f"{server.base_url}/media/photo0.jpg"])]:
+        downloader.submit(record)
+    stats = downloader.close()
+
+    assert sorted(server.requests) == ['/media/photo3.jpg', '/media/photo4.jpg', '/missing'] # Failures are tried again
+    assert stats['cached'] == 1 # photo0 linked to tweet 6 from the manifest
+    assert len([entry for entry in read_manifest(out_dir) if entry['tweet'] in ('0', '1', '2')]) == 3 # Not linked twice
+
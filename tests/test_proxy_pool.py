@@ -0,0 +1,127 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import scraper
+
+PROBE_URL = 'http://probe.test/generate_204'
+
+
+def start_proxy(delay=0.0, status=200):
+    """Local stand-in for an HTTP proxy: answers every proxied GET itself. Returns (server, 'host:port')."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.requests += 1
+            time.sleep(delay)
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"127.0.0.1:{server.server_port}"
+
+
+def unused_address():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+
+@pytest.fixture
+def proxies():
+    servers = {}
+    servers['fast'] = start_proxy()
+    servers['slow'] = start_proxy(delay=0.2)
+    servers['auth'] = start_proxy(status=407) # Proxy asking for credentials: an HTTP error, not healthy
+    yield {name: address for name, (server, address) in servers.items()}, {name: server for name, (server, address) in servers.items()}
+    for server, _ in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def make_pool(proxy_list, cache_path, **options):
+    return scraper.ProxyPool(proxy_list, probe_url=PROBE_URL, cache_path=str(cache_path), rounds=2, timeout=2, **options)
+
+
+def test_probe_ranks_healthy_proxies_by_latency(proxies, tmp_path):
+    addresses, _ = proxies
+    dead = unused_address()
+    pool = make_pool([addresses['slow'], dead, addresses['fast'], addresses['auth']], tmp_path / 'proxy_health.json')
+
+    assert pool.probe() == [addresses['fast'], addresses['slow']]
+    assert pool.health[dead]['successes'] == 0
+    assert pool.health[addresses['auth']]['successes'] == 0
+    # Sessions are spread over the healthy proxies, best first
+    assert [pool.acquire() for _ in range(3)] == [addresses['fast'], addresses['slow'], addresses['fast']]
+    pool.release(addresses['fast'])
+    assert pool.acquire() == addresses['fast']
+
+
+def test_probe_reuses_fresh_cached_results_until_ttl(proxies, tmp_path):
+    addresses, servers = proxies
+    cache_path = tmp_path / 'proxy_health.json'
+    make_pool([addresses['fast'], addresses['slow']], cache_path).probe()
+    assert servers['fast'].requests == 2
+    assert set(json.loads(cache_path.read_text())[PROBE_URL]) == {addresses['fast'], addresses['slow']}
+
+    cached_pool = make_pool([addresses['fast'], addresses['slow']], cache_path)
+    assert cached_pool.probe() == [addresses['fast'], addresses['slow']]
+    assert servers['fast'].requests == 2 # Nothing probed again
+
+    make_pool([addresses['fast'], addresses['slow']], cache_path).probe(force=True)
+    assert servers['fast'].requests == 4
+
+    make_pool([addresses['fast'], addresses['slow']], cache_path, ttl=0).probe() # Every cached result is stale
+    assert servers['fast'].requests == 6
+
+
+def test_recheck_takes_a_failing_proxy_out_of_rotation(proxies, tmp_path):
+    addresses, servers = proxies
+    cache_path = tmp_path / 'proxy_health.json'
+    pool = make_pool([addresses['fast'], addresses['slow']], cache_path)
+    pool.probe()
+
+    assert pool.recheck(addresses['slow'])
+    assert pool.ranked() == [addresses['fast'], addresses['slow']]
+
+    servers['fast'].shutdown()
+    servers['fast'].server_close()
+    assert not pool.recheck(addresses['fast'])
+    assert pool.ranked() == [addresses['slow']]
+    assert pool.acquire() == addresses['slow']
+    # Dropped from the cache as well, so the next run probes it again
+    assert addresses['fast'] not in json.loads(cache_path.read_text())[PROBE_URL]
+
+
+def test_save_cache_from_concurrent_rechecks(proxies, tmp_path):
+    addresses, _ = proxies
+    cache_path = tmp_path / 'proxy_health.json'
+    pool = make_pool([addresses['fast'], addresses['slow']], cache_path)
+    pool.probe()
+    errors = []
+
+    def save_repeatedly():
+        try:
+            for _ in range(25):
+                pool.save_cache()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save_repeatedly) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert set(json.loads(cache_path.read_text())[PROBE_URL]) == {addresses['fast'], addresses['slow']}
@@ -0,0 +1,54 @@
+import json
+import os
+
+import scraper
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'search_timeline.json')
+
+
+def load_fixture():
+    with open(FIXTURE, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_parse_timeline_payload_reads_tweets_in_timeline_order():
+    tweets = scraper.parse_timeline_payload(load_fixture())
+
+    assert [scraper.parse_status_permalink(tweet['permalink']) for tweet in tweets] == [
+        ('@example_news', '1760000000000000001'),
+        ('@wx_watcher', '1759999999999999002'), # Unwrapped from TweetWithVisibilityResults, handle from user core
+    ]
+    assert [tweet['user'] for tweet in tweets] == ['@example_news', '@wx_watcher']
+
+
+def test_parse_timeline_payload_normalizes_timestamp_and_text():
+    first, second = scraper.parse_timeline_payload(load_fixture())
+
+    assert first['timestamp'] == '2024-02-21T09:15:42.000Z'
+    assert second['timestamp'] == '2024-02-21T06:02:10.000Z' # +0100 converted to UTC
+    assert first['text'] == 'Storm update & road closures https://t.co/abc123 https://t.co/pic1'
+    assert second['text'] == 'Long post: the storm is moving east, expect heavy rain through the evening.' # note_tweet wins
+
+
+def test_parse_timeline_payload_extra_counts_media_and_links():
+    first, second = scraper.parse_timeline_payload(load_fixture())
+
+    assert first['extra'] == {
+        'likes': 120,
+        'retweets': 34,
+        'replies': 5,
+        'quotes': 2,
+        'reply_to_status_id': None,
+        'quoted_status_id': None,
+        'media': ['https://pbs.twimg.com/media/GGphoto1.jpg?name=orig', 'https://pbs.twimg.com/media/GGphoto2.jpg?name=orig'],
+        'links': ['https://example.org/roads'],
+    }
+    assert second['extra']['reply_to_status_id'] == '1759999999999990000'
+    assert second['extra']['quoted_status_id'] == '1759999999999980000'
+    assert second['extra']['media'] == ['https://video.twimg.com/ext_tw_video/1/pu/vid/1280x720/high.mp4'] # Highest-bitrate MP4
+    assert second['extra']['links'] == []
+
+
+def test_parse_timeline_payload_ignores_cursors_and_empty_payloads():
+    assert scraper.parse_timeline_payload({}) == []
+    assert scraper.parse_timeline_payload({'data': {'tweet_results': {'result': {'rest_id': '1'}}}}) == [] # No legacy
@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+
+import scraper
+
+BASE = datetime.datetime(2024, 1, 31, 12, tzinfo=datetime.timezone.utc)
+
+
+def tweet(status_id):
+    timestamp = BASE + datetime.timedelta(minutes=status_id)
+    return {'user': '@u', 'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'text': f"tweet {status_id}", 'status_id': str(status_id)}
+
+
+class FakeDriver:
+    title = 'X'
+
+    class resource_monitor:
+        @staticmethod
+        def report(prefix=''):
+            pass
+
+    def quit(self):
+        pass
+
+
+class FakeTimeline:
+    """Stands in for iter_tweets on a Latest timeline: one script step per poll, then Ctrl+C."""
+
+    def __init__(self, steps):
+        self.status_ids = []
+        self.steps = list(steps)
+
+    def __call__(self, driver, search_url, max_tweets=100, seen_index=None, watermark=None, outcome=None, **options):
+        if not self.steps:
+            raise KeyboardInterrupt
+        new_tweets, fail_after = self.steps.pop(0)
+        self.status_ids.extend(range(len(self.status_ids) + 1, len(self.status_ids) + new_tweets + 1))
+        outcome['stop_reason'] = None
+        gathered = 0
+        for status_id in reversed(self.status_ids):
+            if gathered >= max_tweets:
+                return
+            record = tweet(status_id)
+            if watermark and scraper.at_or_below_watermark(record, watermark):
+                outcome['stop_reason'] = 'watermark'
+                return
+            if not seen_index.add(scraper.tweet_key(record)):
+                continue
+            if fail_after is not None and gathered == fail_after:
+                raise scraper.ThrottledError("still throttled")
+            gathered += 1
+            yield record
+        outcome['stop_reason'] = 'end'
+
+
+def watch(tmp_path, monkeypatch, steps, max_tweets=10):
+    monkeypatch.setattr(scraper, 'iter_tweets', FakeTimeline(steps))
+    output = tmp_path / 'out.jsonl'
+    watermarks = tmp_path / 'watermarks.json'
+    job = {'mode': 'hashtag', 'query': 'python', 'search_type': 'latest', 'start_date': None, 'end_date': None,
+           'max_tweets': max_tweets, 'skip_seen': False, 'output': str(output)}
+    scraper.watch_jobs(FakeDriver(), [job], interval_sec=0, output_format='jsonl', watermark_path=str(watermarks))
+    status_ids = [int(record['status_id']) for record in scraper.read_output_records(str(output))]
+    return status_ids, scraper.load_watermarks(str(watermarks))['hashtag:python']
+
+
+def test_capped_polls_fill_the_gap_before_moving_the_watermark(tmp_path, monkeypatch):
+    # 10 tweets at the first poll, then 30 new ones polled 10 at a time
+    status_ids, watermark = watch(tmp_path, monkeypatch, [(10, None), (30, None), (0, None), (0, None), (0, None)])
+
+    assert sorted(status_ids) == list(range(1, 41))
+    assert watermark['status_id'] == '40'
+    assert 'pending' not in watermark
+
+
+def test_capped_poll_keeps_the_watermark_with_pending_tweets(tmp_path, monkeypatch):
+    status_ids, watermark = watch(tmp_path, monkeypatch, [(10, None), (30, None)])
+
+    assert sorted(status_ids) == list(range(1, 11)) + list(range(31, 41))
+    assert watermark['status_id'] == '10'
+    assert watermark['pending']['newest']['status_id'] == '40'
+    assert sorted(watermark['pending']['keys'], key=int) == [str(status_id) for status_id in range(31, 41)]
+
+
+@pytest.mark.parametrize('fail_after', [0, 4])
+def test_failed_poll_is_finished_by_the_next_one(tmp_path, monkeypatch, fail_after):
+    status_ids, watermark = watch(tmp_path, monkeypatch, [(10, None), (8, fail_after), (0, None)])
+
+    assert sorted(status_ids) == list(range(1, 19))
+    assert watermark['status_id'] == '18'
+    assert 'pending' not in watermark